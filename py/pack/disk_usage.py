@@ -1,19 +1,40 @@
+import time
+
+# Taken before anything else is imported, --profile-startup reports from here
+_import_start = time.perf_counter()
+
+import argparse
 import errno
 import os
+import re
 import shutil
 import signal
+import stat
+import struct
+import sys
+import unicodedata
 from datetime import datetime, timedelta
 from pathlib import Path
-from multiprocessing import Pool
-from typing import List, Tuple, Iterator, Dict, Any, Callable
-from prettytable import PrettyTable, PLAIN_COLUMNS
+from collections import deque
+from typing import List, Tuple, Iterator, Dict, Any, Callable, Deque, Union, TYPE_CHECKING
 
-from cli_args import BaseTap
+from cli_args import BaseTap, RegExArg
 
 from utils import pretty_size, int_safe, ShellColors, truncate, distinct, human_int
 from logger import Logger
 
-from disk_usage_models import Dir, State, Field, Grid, BareStat, Stat
+from disk_usage_models import Dir, State, Field, Grid, BareStat, Stat, DirRecord
+from disk_usage_cache import ScanCache, cache_file, load_cache
+from disk_usage_exclude import ExcludeMatcher, read_exclude_file
+from disk_usage_filters import ScanFilter
+
+# Only imported by the code paths that use them, small scans shouldn't pay for the pool, curses or the output formats
+if TYPE_CHECKING:
+    from disk_usage_formats import NdjsonWriter
+    from disk_usage_snapshot import DiffRow
+    from disk_usage_remote import AgentWriter
+
+_imports_done = time.perf_counter()
 
 
 def get_term_cols():
@@ -27,8 +48,22 @@ _fields: Dict[str, Callable[[Stat], Any]] = {
     'count': lambda d: d.file_count,
     'density': lambda d: d.density,
     'max': lambda d: d.max_size,
+    'p50': lambda d: d.percentile(50),
+    'p90': lambda d: d.percentile(90),
+    'p99': lambda d: d.percentile(99),
 }
-_field_choices = [f for f in _fields.keys() if f != 'size']
+# Grid only, a sparkline of the file count per size range
+_hist_field = 'hist'
+_field_choices = [f for f in _fields.keys() if f != 'size'] + [_hist_field]
+# Fields the grid adds on its own when they fit, the rest only show up through -f or -s
+_auto_fields = ['density', 'count', 'max']
+_formats = ['grid', 'csv', 'tsv', 'json', 'ndjson']
+# Set by --serve, rows go out as frames of the agent protocol instead of any of the formats
+_serve_format = 'serve'
+_backends = ['auto', 'processes', 'threads']
+# Latency bound filesystems, --backend auto walks these with threads
+_network_fs = {'nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', '9p', 'afs', 'ceph', 'glusterfs', 'lustre', 'davfs',
+               'fuse.sshfs', 'fuse.rclone', 'fuse.glusterfs', 'fuse.s3fs'}
 
 
 class Args(BaseTap):
@@ -41,20 +76,86 @@ class Args(BaseTap):
     trace: bool = False
     no_term_colors: bool = False
     exclude_hidden: bool = False
-    exclude_folders: List[Path] = []
+    exclude: List[str]
     csv: bool
+    format: str
+    measure_ipc: bool
+    live: bool
+    no_cache: bool
+    refresh: bool
+    depth: int = 1
+    top_k: int = 5
+    browse: bool
+    disk_usage: bool
+    dedupe_inodes: bool
+    max_iops: int = None
+    nice: bool
+    snapshot: Path = None
+    diff: Path = None
+    diff_limit: int = 25
+    top_files: int = 0
+    newest: int = 0
+    by_ext: bool
+    profile_startup: bool
+    backend: str = 'auto'
+    io_threads: int = 64
+    remotes: List[str]
+    serve: bool
+    remote_cmd: str = None
+    error_log: Path = None
+    file_filter: re.Pattern = None
+    directory_filter: re.Pattern = None
+    path_filter: re.Pattern = None
+    glob: str = None
+    summary: bool
 
     def configure(self) -> None:
         self.description = "A beefed up du"
-        self.add_root_optional('Path to scan')
+        self.add_root_optional('Path to scan, or host:/path to scan it with an agent on that host')
+        self.add_argument('remotes', nargs='*', type=str, default=[], help='More host:/path targets, scanned at once and merged into one grid')
         self.add_multi_choice('-f', '--fields', help="Fields to output", choices=_field_choices, default=None)
         self.add_optional('-s', '--sort', help='Sort by field', choices=list(_fields.keys()), default='size')
         self.add_flag('-r', '--sort-reversed', help='Reversed sort')
-        self.add_argument("-th", "--threads", help="Max threads", type=int)
+        self.add_argument("-th", "--threads", help="Max threads, the worker processes of the processes backend", type=int)
+        self.add_optional('--backend', help='processes work around the GIL on local disks, threads overlap the round trips of network shares. '
+                                            'auto picks by the filesystem of the root', choices=_backends, default='auto')
+        self.add_optional('--io-threads', help='Threads used by the threads backend', type=int, default=64)
         self.add_flag("-eh", "--exclude-hidden", help="Exclude hidden files and folders")
+        self.add_multi("-e", "--exclude", type=str,
+                       help="Folders to skip, on top of ~/.duh_exclude. Paths, folder names, globs (** crosses folders) or re:<regex> searched in the absolute path")
         self.add_flag("--timed", help="Print seek time")
         self.add_flag("--no-term-colors", help="Disable terminal colors")
-        self.add_flag("--csv", help="Prints CSV compatible")
+        self.add_flag("--csv", help="Prints CSV compatible, same as --format csv")
+        self.add_optional('--format', help='Output format, ndjson streams rows as folders complete', choices=_formats, default='grid')
+        # Used by duh-bench, re-pickles every task and result in the parent to count the bytes crossing the pool
+        self.add_argument('--measure-ipc', action='store_true', help=argparse.SUPPRESS, default=False)
+        self.add_flag("--live", help="Redraw the grid as folders finish scanning")
+        self.add_flag("--no-cache", help="Don't read or write the scan cache")
+        self.add_flag("--refresh", help="Ignore the scan cache and rebuild it, picks up files changed in place")
+        self.add_argument("-d", "--depth", help="Levels of sub folders to break down, from the same walk", type=int, default=1)
+        self.add_argument("-k", "--top-k", help="Sub folders listed per folder with --depth", type=int, default=5)
+        self.add_flag("-b", "--browse", help="Browse the scanned tree interactively")
+        self.add_flag("-du", "--disk-usage", help="Count allocated blocks instead of apparent size, sparse files count what they use")
+        self.add_flag("--dedupe-inodes", help="Count hard linked files once, like du (bypasses the scan cache)")
+        self.add_optional("--max-iops", help="Cap listings and stats per second across all threads", type=int)
+        self.add_flag("--nice", help="Scan at lowered CPU priority and idle IO priority")
+        self.add_optional("--snapshot", help="Save the scanned tree to a snapshot file for a later --diff (bypasses the scan cache)", type=Path)
+        self.add_optional("--diff", help="Compare against a snapshot, lists the folders that grew most (shrank with -r) down to --depth (bypasses the scan cache)", type=Path)
+        self.add_optional("--diff-limit", help="Folders listed by --diff", type=int, default=25)
+        self.add_optional("--top-files", help="List the N largest files under the grid (bypasses the scan cache)", type=int, default=0)
+        self.add_optional("--newest", help="List the N most recently modified files under the grid (bypasses the scan cache)", type=int, default=0)
+        self.add_flag("--by-ext", help="Break the files down by extension too, in a second grid (bypasses the scan cache)")
+        self.add_optional("-ff", "--file-filter", help="Only count files whose name matches this regex (bypasses the scan cache, like the other filters)", type=RegExArg)
+        self.add_optional("-df", "--directory-filter", help="Only scan folders whose name matches this regex, at every level", type=RegExArg)
+        self.add_optional("-pf", "--path-filter", help="Only count files whose absolute path matches this regex, without -ff and -df it prunes folders too", type=RegExArg)
+        self.add_optional("--glob", help="Only count files whose name matches this glob, top level folders have to match it too")
+        self.add_flag("--summary", help="Only print the total row")
+        self.add_optional("--error-log", help="Write every error of a local scan to this file, the output only lists a few per kind", type=Path)
+        self.add_flag("--serve", help="Run as an agent, streams the rows of root to stdout in the binary protocol host:/path targets read")
+        self.add_optional("--remote-cmd", help="Command starting the agent for host:/path targets, {host} is filled in and the agent arguments are "
+                                               "appended quoted for the remote shell, like ssh expects. Defaults to 'ssh {host} duh', the host local "
+                                               "runs this copy directly")
+        self.add_flag("--profile-startup", help="Print where the time went before and after the scan, and the slowest imports, to stderr")
         self.add_trace()
 
     def process_args(self) -> None:
@@ -65,6 +166,41 @@ class Args(BaseTap):
         if self.fields:
             self.fields = distinct(self.fields)
 
+        if self.csv:
+            self.format = 'csv'
+
+        if self.serve:
+            self.format = _serve_format
+
+        self.targets = []
+
+        if self.remotes or ':' in self.root.as_posix():
+            from disk_usage_remote import parse_target, label_targets
+
+            # An existing local root is always scanned locally, whatever colons are in its name
+            root_target = parse_target(self.root.as_posix())
+
+            if self.remotes or root_target:
+                specs = [self.root.as_posix()] + self.remotes
+                self.targets = [root_target] + [parse_target(spec) for spec in self.remotes]
+
+                if None in self.targets:
+                    _log.error(f'Not a host:/path target: {specs[self.targets.index(None)]}. Local paths can\'t be mixed with remote ones.')
+                    exit(1)
+
+                label_targets(self.targets)
+                # Agents only send their top level rows and a sample of their errors, nothing below them crosses the wire
+                unsupported = [name for (name, on) in (('--snapshot', self.snapshot), ('--diff', self.diff), ('--browse', self.browse),
+                                                       ('--depth', self.depth > 1), ('--by-ext', self.by_ext), ('--top-files', self.top_files),
+                                                       ('--newest', self.newest), ('--serve', self.serve), ('--error-log', self.error_log)) if on]
+
+                if unsupported:
+                    _log.error(f'{", ".join(unsupported)} can\'t be used with host:/path targets.')
+                    exit(1)
+
+        if self.backend == 'auto':
+            self.backend = 'threads' if mount_fs_type(self.root) in _network_fs else 'processes'
+
         if self.threads is None:
             cores = int_safe(os.environ.get('ZSHCOM__cpu_cores'))
 
@@ -76,168 +212,488 @@ class Args(BaseTap):
             else:
                 self.threads = 1
 
-            if self.threads < 2:
+            # Logger writes to stdout, keep it out of machine readable output
+            if self.threads < 2 and self.backend == 'processes' and self.format == 'grid' and not self.targets:
                 _log.warn('Running in single-threaded mode')
 
+        if self.max_iops is not None and self.max_iops < 1:
+            _log.error('--max-iops must be 1 or greater.')
+            exit(1)
+
+        # Size of the pool, threads mostly wait on the server so many more of them pay off than there are cores
+        self.workers = self.io_threads if self.backend == 'threads' else self.threads
+
+        if self.diff is not None and not self.diff.is_file():
+            _log.error(f'Snapshot {self.diff.as_posix()} not found.')
+            exit(1)
+
+        if self.error_log is not None:
+            try:
+                # Workers append to it as they go, each run starts it over
+                self.error_log.write_text('')
+            except OSError as e:
+                _log.error(f'Unable to write {self.error_log.as_posix()}: {e.strerror}')
+                exit(1)
+
+        self.filters = ScanFilter(self.glob, self.file_filter, self.directory_filter, self.path_filter)
+        self.throttle = None
+
+        if self.max_iops:
+            from disk_usage_throttle import TokenBucket
+            self.throttle = TokenBucket(self.max_iops)
+
         # noinspection SpellCheckingInspection
-        efpath = Path(Path.home() / '.duh_exclude')
+        self.excluder = ExcludeMatcher(read_exclude_file(Path.home() / '.duh_exclude') + (self.exclude or []), self.exclude_hidden)
+
+        for rule in self.excluder.missing:
+            _log.trace(f'Exclusion {rule} does not exist, skipped')
 
-        if efpath.exists():
-            with efpath.open() as f:
-                for line in f.readlines():
-                    if line:
-                        lp = Path(line.strip())
-                        if lp.is_dir():
-                            self.exclude_folders.append(lp.resolve())
+        for (rule, error) in self.excluder.invalid:
+            _log.error(f'Exclusion {rule} is not a valid regex ({error}), skipped')
 
 
 _args: Args
+_cache: Union[ScanCache, None] = None
 _size_field_width = 7
 _name_min_width = 17
+# Directories a pool task lists before handing the rest of its queue back to be split across idle workers
+_task_dir_budget = 256
+# Directories the parent lists on its own before starting a pool, trees smaller than this never fork
+_serial_dir_budget = 128
+_live_redraw_interval = 0.5
+_name_field = 'Folder'
+_ansi_escape = re.compile(r'\033\[[0-9;]*m')
+_ext_name_field = 'Extension'
+# --by-ext grid rows past this many are folded into one, machine readable output lists them all
+_ext_grid_rows = 25
+# perf_counter stamps taken as main gets through each phase, see --profile-startup
+_phases: Dict[str, float] = {}
+_profiled_imports = 8
+
+# (path, st_dev, st_ino, st_mtime_ns, st_blocks) of a directory waiting to be listed
+WorkItem = Tuple[str, int, int, int, int]
+# (directory, files, sub dir names, cache record if the listing was skipped, listed without errors)
+WalkStep = Tuple[WorkItem, List[os.DirEntry], List[str], Union[DirRecord, None], bool]
+# Called with a top level row each time results for it are merged, complete once nothing is left to scan under it
+RowCallback = Union[Callable[[Stat, bool], None], None]
+
+
+def mount_fs_type(path: Path) -> Union[str, None]:
+    """Filesystem type of the mount holding path, None where there is no /proc/mounts"""
+    try:
+        with open('/proc/mounts') as f:
+            mounts = [line.split() for line in f]
+    except OSError:
+        return None
+
+    target = os.path.realpath(path)
+    (best, fs_type) = ('', None)
+
+    for parts in mounts:
+        if len(parts) < 3:
+            continue
+
+        # Spaces and the like are octal escaped in mount points
+        mount = re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), parts[1])
+
+        # Later mounts on the same point shadow earlier ones
+        if (target == mount or target.startswith(mount.rstrip('/') + '/')) and len(mount) >= len(best):
+            (best, fs_type) = (mount, parts[2])
+
+    return fs_type
+
+
+def exclude_dir(path: str, st: os.stat_result, state: State, args: Args) -> bool:
+    # Paths are joined onto the resolved root and symlinks are never followed, so they are already canonical
+    rule = args.excluder.match(path, st) if args.excluder else None
+
+    if rule is not None:
+        state.excluded(rule, Path(path))
+
+    return rule is not None
+
 
+def filter_dir(name: str, path: str, state: State, args: Args, top: bool = False) -> bool:
+    # Checked before the stat, a pruned folder costs a regex match
+    option = args.filters.match_dir(name, path, top) if args.filters else None
 
-def exclude_dir(d: Path, args: Args) -> bool:
-    return (args.exclude_hidden and d.name.startswith('.')) or d.resolve() in args.exclude_folders or d.is_mount() or d.is_symlink()
+    if option is not None:
+        state.filtered(option)
 
+    return option is not None
 
-def walk_dir(wdir: Path, state: State, log: Logger, args: Args) -> Iterator[Tuple[Path, List[Path]]]:
-    log.trace(f'Walking {wdir.as_posix()}')
-    dirs_left: List[Path] = [wdir]
 
-    while len(dirs_left) > 0:
-        cd = dirs_left.pop(0)
+def filter_file(f: os.DirEntry, state: State, args: Args) -> bool:
+    option = args.filters.match_file(f.name, f.path) if args.filters else None
+
+    if option is not None:
+        state.filtered(option)
+
+    return option is not None
+
+
+def throttle(n: int, state: State, args: Args) -> None:
+    if args.throttle:
+        state.counters.throttle_wait_ns += args.throttle.take(n)
+
+
+def walk_cached(cd: str, cd_dev: int, cached: DirRecord, dirs_left: Deque[WorkItem], state: State, args: Args) -> None:
+    # The listing is skipped, sub dirs still need a stat to check them against the cache in turn
+    throttle(len(cached.sub_dirs), state, args)
+
+    for name in cached.sub_dirs:
+        sub = f'{cd}/{name}'
+        state.counters.stats += 1
+
+        try:
+            st = os.lstat(sub)
+        except OSError as e:
+            if e.errno == errno.EACCES:
+                state.error('Permission denied in', Path(sub))
+            elif e.errno not in (errno.ENOENT, errno.ESTALE):
+                raise e
+            continue
+
+        if not stat.S_ISDIR(st.st_mode) or st.st_dev != cd_dev:
+            continue
+
+        if not exclude_dir(sub, st, state, args):
+            dirs_left.append((sub, st.st_dev, st.st_ino, st.st_mtime_ns, st.st_blocks))
+
+
+def walk_dir(dirs_left: Deque[WorkItem], state: State, log: Logger, args: Args, cache: Union[ScanCache, None] = None,
+             max_dirs: Union[int, None] = None) -> Iterator[WalkStep]:
+    """Lists directories from dirs_left until it is empty or max_dirs have been listed, anything left over stays in dirs_left"""
+    listed = 0
+
+    while len(dirs_left) > 0 and (max_dirs is None or listed < max_dirs):
+        item = dirs_left.popleft()
+        (cd, cd_dev, cd_ino, cd_mtime_ns, _) = item
+        listed += 1
+
+        if cache:
+            cached = cache.lookup(cd, cd_ino, cd_mtime_ns)
+
+            if cached is not None:
+                log.trace(f'Cached     {cd}')
+                state.counters.cache_hits += 1
+                walk_cached(cd, cd_dev, cached, dirs_left, state, args)
+                yield item, [], [], cached, True
+                continue
+
+            state.counters.cache_misses += 1
+
+        throttle(1, state, args)
 
         try:
-            cd_it = list(cd.iterdir())
+            with os.scandir(cd) as cd_it:
+                entries = list(cd_it)
+            state.counters.listings += 1
         except OSError as e:
             if e.errno == errno.EACCES:
-                state.error('Permission denied in', cd)
+                state.error('Permission denied in', Path(cd))
                 continue
             else:
                 raise e
 
-        log.trace(f'Getting fs {cd.as_posix()}')
-        if cd_it:
-            files: List[Path] = []
+        log.trace(f'Getting fs {cd}')
+        # Charged up front for the stats the sub dirs and files are about to take
+        throttle(len(entries), state, args)
+        files: List[os.DirEntry] = []
+        sub_dirs: List[str] = []
+        clean = True
 
-            for fso in cd_it:
-                try:
-                    if not fso.is_mount() and not fso.is_symlink():
-                        if fso.is_dir():
-                            if not exclude_dir(fso, args):
-                                dirs_left.append(fso)
-                            else:
-                                state.error('Excluded', fso)
-                        elif fso.is_file():
-                            files.append(fso)
-                except OSError as e:
-                    if e.errno == errno.EACCES:
-                        state.error('Permission denied in', fso)
-                    elif e.errno != errno.ESTALE:
-                        raise e
-
-            yield cd, files
-
-
-def process_files(files: List[Path], task_state: State, args: Args) -> Tuple[State, List[int]]:
-    sizes: List[int] = []
+        for entry in entries:
+            try:
+                # d_type from the listing answers is_dir/is_file without a syscall
+                if entry.is_dir(follow_symlinks=False):
+                    sub_dirs.append(entry.name)
+
+                    if filter_dir(entry.name, entry.path, state, args):
+                        continue
+
+                    state.counters.stats += 1
+                    est = entry.stat(follow_symlinks=False)
+
+                    if est.st_dev != cd_dev:
+                        continue
+
+                    if not exclude_dir(entry.path, est, state, args):
+                        dirs_left.append((entry.path, est.st_dev, est.st_ino, est.st_mtime_ns, est.st_blocks))
+                elif entry.is_file(follow_symlinks=False):
+                    files.append(entry)
+            except OSError as e:
+                if e.errno == errno.EACCES:
+                    state.error('Permission denied in', Path(entry.path))
+                    clean = False
+                elif e.errno != errno.ESTALE:
+                    raise e
+
+        yield item, files, sub_dirs, None, clean
+
+
+def stat_size(st: os.stat_result, args: Args) -> int:
+    # st_blocks is always in 512 byte units, whatever the filesystem block size
+    return st.st_blocks * 512 if args.disk_usage else st.st_size
+
+
+def process_files(files: List[os.DirEntry], dr: Dir, path: str, task_state: State, args: Args) -> bool:
+    """Returns False if any file couldn't be stat'ed, path is the folder holding the files"""
+    clean = True
 
     for f in files:
         if args.exclude_hidden and f.name.startswith('.'):
             continue
 
+        if filter_file(f, task_state, args):
+            continue
+
+        task_state.counters.stats += 1
+
         # noinspection PyBroadException
         try:
-            sizes.append(f.stat().st_size)
+            st = f.stat(follow_symlinks=False)
+            size = stat_size(st, args)
+
+            # Only inodes with more than one link can show up twice, the rest never touch the set
+            if args.dedupe_inodes and st.st_nlink > 1:
+                inode = (st.st_dev, st.st_ino)
+
+                if inode in task_state.inodes:
+                    continue
+
+                task_state.inodes[inode] = (size, dr.name, path)
+
+            dr.add_file(size)
+            task_state.counters.files += 1
+
+            if task_state.tracks_files:
+                task_state.track_file(size, st.st_mtime_ns, f.path)
+
+            if args.by_ext:
+                task_state.add_ext(os.path.splitext(f.name)[1].lower(), size)
         except:
-            task_state.error('Unable to stat', f)
+            task_state.error('Unable to stat', Path(f.path))
+            clean = False
+
+    return clean
 
-    # noinspection PyRedundantParentheses
-    return (task_state, sizes)
 
+def scan_dirs(top: str, dirs: List[WorkItem], task_state: State, max_dirs: Union[int, None] = None) -> Tuple[str, State, List[WorkItem]]:
+    """Walks dirs crediting everything to the top level row named top, returns the directories left once max_dirs is hit"""
+    dirs_left: Deque[WorkItem] = deque(dirs)
+    dr = Dir(top)
 
-def process_root_fso(fso: Path, task_state: State, log: Logger, args: Args) -> State:
     # noinspection PyBroadException
     try:
-        log.trace(f'Processing {fso.as_posix()}')
-        if fso.is_dir() and not exclude_dir(fso, args):
-            dr = Dir(fso.name)
+        _log.trace(f'Processing {top} ({len(dirs)} dirs)')
 
-            for path, files in walk_dir(fso, task_state, log, args):
-                log.trace(f'Scanning   {path.as_posix()}')
-                if args.exclude_hidden and path.name.startswith('.'):
-                    continue
+        for ((path, _, ino, mtime_ns, blocks), files, sub_dirs, cached, clean) in walk_dir(dirs_left, task_state, _log, _args, _cache, max_dirs):
+            _log.trace(f'Scanning   {path}')
+
+            if cached is None:
+                ds = Dir(top)
+                clean = process_files(files, ds, path, task_state, _args) and clean
 
-                (_, s) = process_files(files, task_state, args)
-                dr.sizes += s
-                dr.had_error(task_state.has_errors)
+                if _args.disk_usage:
+                    # du counts the blocks of the directory itself too
+                    ds.add_size(blocks * 512)
 
-            task_state.add_dir(dr)
-        elif fso.is_file():
-            task_state.error('process_root_fso is file', fso)
+                if collect_records():
+                    cached = DirRecord.from_stat(ino, mtime_ns, ds, sub_dirs, not clean)
+            else:
+                ds = cached.to_stat(top)
+                task_state.counters.files += cached.file_count
+
+            dr.merge(ds)
+
+            if cached is not None:
+                task_state.dir_records[path] = cached
     except OSError as e:
         if e.errno == errno.EACCES:
-            task_state.error('Permission denied in', fso)
+            task_state.error('Permission denied in', Path(top))
         elif e.errno != errno.ESTALE:
-            task_state.error(f'OSERROR ({e.errno})', fso)
+            task_state.error(f'OSERROR ({e.errno})', Path(top))
     except Exception as e:
-        task_state.error(f'Unhandled Exception: {e}', fso)
+        task_state.error(f'Unhandled Exception: {e}', Path(top))
 
-    log.trace(f'Completed  {fso.as_posix()}')
-    return task_state
+    dr.had_error(task_state.has_errors)
+    task_state.add_dir(dr)
 
+    _log.trace(f'Completed  {top} ({len(dirs_left)} dirs handed back)')
+    # noinspection PyRedundantParentheses
+    return (top, task_state, list(dirs_left))
 
-def collect_sizes_parallel(state: State, dirs: List[Path], root_files: List[Path]) -> None:
-    pool_objs = [(d, state.task_state(d), _log, _args) for d in dirs]
+
+def collect_records() -> bool:
+    return _cache is not None or _args.depth > 1 or _args.browse or _args.snapshot is not None or _args.diff is not None
+
+
+def rescan_subtree(path: str) -> Tuple[Dict[str, DirRecord], int]:
+    try:
+        st = os.lstat(path)
+    except FileNotFoundError:
+        return {}, 0
+
+    (_, task_state, _) = scan_dirs(Path(path).name, [(path, st.st_dev, st.st_ino, st.st_mtime_ns, st.st_blocks)], State(Path(path), Dir('./'), BareStat('Total')))
+
+    return task_state.dir_records, task_state.error_count
+
+
+def subtree_rows(state: State, d: Stat, sorter: Callable[[Stat], Any]) -> List[Stat]:
+    path = (state.root / d.name).as_posix()
+
+    # The root files row and excluded dirs have nothing to break down
+    if d is state.root_stat or path not in state.dir_records:
+        return []
+
+    from disk_usage_tree import build_tree, iter_tree
+
+    rows: List[Stat] = []
+    node = build_tree(d.name, path, 1, state.dir_records, _args.depth)
+
+    for n in iter_tree(node.children, sorter, not _args.sort_reversed, _args.top_k):
+        n.stat.name = Path(n.path).relative_to(state.root).as_posix() if _args.format != 'grid' else f'{"  " * (n.depth - 1)}{n.name}'
+        rows.append(n.stat)
+
+    return rows
+
+
+def tree_rows(state: State, sorted_dirs: List[Stat], sorter: Callable[[Stat], Any]) -> List[Stat]:
+    rows: List[Stat] = []
+
+    for d in sorted_dirs:
+        rows.append(d)
+        rows += subtree_rows(state, d, sorter)
+
+    return rows
+
+
+def split_work(dirs: List[WorkItem], parts: int) -> List[List[WorkItem]]:
+    # Interleaved so each chunk gets a similar mix of shallow and deep directories
+    return [dirs[i::parts] for i in range(min(parts, len(dirs)))]
+
+
+def init_worker(log: Logger, args: Args, cache: Union[ScanCache, None]) -> None:
+    global _log, _args, _cache
+
+    _log = log
+    _args = args
+    _cache = cache
+
+
+def collect_root_files(state: State, root_files: List[os.DirEntry]) -> None:
+    task_state = state.task_state(state.root)
+    process_files(root_files, task_state.root_stat, state.root.as_posix(), task_state, _args)
+    task_state.root_stat.had_error(task_state.has_errors)
+    state.merge(task_state)
+
+
+def scan_serial_prefix(state: State, dirs: List[WorkItem], on_row: RowCallback = None) -> List[Tuple[str, List[WorkItem]]]:
+    """Walks the tops in the parent until _serial_dir_budget directories are listed, returns the work left for the pool"""
+    budget = _serial_dir_budget
+    work: List[Tuple[str, List[WorkItem]]] = []
+
+    for item in dirs:
+        top = Path(item[0]).name
+
+        if budget <= 0:
+            work.append((top, [item]))
+            continue
+
+        (_, task_state, dirs_left) = scan_dirs(top, [item], state.task_state(state.root), budget)
+        budget -= task_state.counters.listings + task_state.counters.cache_hits
+        state.merge(task_state)
+
+        for chunk in split_work(dirs_left, _args.workers):
+            work.append((top, chunk))
+
+        if on_row:
+            on_row(state.get_dir(top), not dirs_left)
+
+    return work
+
+
+def collect_sizes_parallel(state: State, dirs: List[WorkItem], root_files: List[os.DirEntry], on_row: RowCallback = None) -> None:
+    # Forking a pool costs more than walking a small tree, it only starts if the tree outgrows the serial budget
+    work = scan_serial_prefix(state, dirs, on_row)
+
+    if not work:
+        collect_root_files(state, root_files)
+        return
+
+    import pickle
+    import queue
+
+    if _args.backend == 'threads':
+        # Same interface, scandir and stat release the GIL while they wait on the filesystem
+        from multiprocessing.pool import ThreadPool as Pool
+    else:
+        from multiprocessing import Pool
+
+    # Workers inherit SIG_IGN so only the parent reacts to ctrl+c
     original_sigint_handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
 
-    with Pool(processes=_args.threads) as pool:
-        sigint_fired = False
+    with Pool(processes=_args.workers, initializer=init_worker, initargs=(_log, _args, _cache)) as pool:
+        signal.signal(signal.SIGINT, original_sigint_handler)
+        completed: queue.SimpleQueue = queue.SimpleQueue()
+        pending = 0
+        pending_by_top: Dict[str, int] = {}
+
+        def submit(top: str, chunk: List[WorkItem]) -> None:
+            nonlocal pending
 
-        def sigint_handler(sig, frame) -> Any:
-            # noinspection PyGlobalUndefined
-            global sigint_fired
+            pending += 1
+            pending_by_top[top] = pending_by_top.get(top, 0) + 1
+            task_args = (top, chunk, state.task_state(state.root), _task_dir_budget)
 
-            _log.trace('SIGINT fired')
-            sigint_fired = True
-            return original_sigint_handler(sig, frame)
+            if _args.measure_ipc and _args.backend == 'processes':
+                state.counters.ipc_bytes += len(pickle.dumps(task_args))
 
-        signal.signal(signal.SIGINT, sigint_handler)
+            pool.apply_async(scan_dirs, task_args, callback=completed.put, error_callback=completed.put)
 
         try:
-            task = pool.starmap_async(process_root_fso, pool_objs)
-            task2 = pool.starmap_async(process_files, [(root_files, state.task_state(state.root), _args)])
-            while not task.ready():
-                if sigint_fired:
-                    _log.trace('Waiting for walk task')
-                continue
-            while not task2.ready():
-                if sigint_fired:
-                    _log.trace('Waiting for root files task')
-                continue
-            _log.trace("Collecting thread results")
-            results: List[State] = task.get()
-            results2: List[State] = task2.get()
+            for (top, chunk) in work:
+                submit(top, chunk)
+
+            # DirEntry can't be pickled, the root files are stat'ed here while the pool walks
+            collect_root_files(state, root_files)
+
+            # Blocks until a worker callback fires, the parent sleeps for the whole scan
+            while pending > 0:
+                result = completed.get()
+                pending -= 1
+
+                if isinstance(result, BaseException):
+                    raise result
+
+                if _args.measure_ipc and _args.backend == 'processes':
+                    state.counters.ipc_bytes += len(pickle.dumps(result))
+
+                (top, task_state, dirs_left) = result
+                pending_by_top[top] -= 1
+                state.merge(task_state)
+
+                if dirs_left:
+                    # Only fan out when workers are about to go idle, otherwise keep the leftovers as one task
+                    for chunk in split_work(dirs_left, max(1, _args.workers - pending)):
+                        submit(top, chunk)
+
+                if on_row:
+                    on_row(state.get_dir(top), pending_by_top[top] == 0)
         except KeyboardInterrupt:
             exit(0)
 
-        for r in results:
-            state.merge(r)
-
-        for (task_state, sizes) in results2:
-            for size in sizes:
-                task_state.add_to_root(size, task_state.has_errors)
-            state.merge(task_state)
 
+def collect_sizes_single(state: State, dirs: List[WorkItem], root_files: List[os.DirEntry], on_row: RowCallback = None) -> None:
+    for item in dirs:
+        (top, task_state, _) = scan_dirs(Path(item[0]).name, [item], state.task_state(state.root))
+        state.merge(task_state)
 
-def collect_sizes_single(state: State, dirs: List[Path], root_files: List[Path]) -> None:
-    for d in dirs:
-        state.merge(process_root_fso(d, state.task_state(d), _log, _args))
+        if on_row:
+            on_row(state.get_dir(top), True)
 
-    (task_state, sizes) = process_files(root_files, state.task_state(state.root), _args)
-    for size in sizes:
-        task_state.add_to_root(size, task_state.has_errors)
-    state.merge(task_state)
+    collect_root_files(state, root_files)
 
 
 def color_field(f: Field, d: Dir, value: str) -> str:
@@ -272,7 +728,8 @@ def print_csv(state: State, sorted_dirs: List[Stat], stopwatch: timedelta):
 
     print_row([f.title() for f in field_keys])
 
-    for d in sorted_dirs:
+    # The grid always ends on the total, the rows here don't, --summary would be left with nothing
+    for d in sorted_dirs + ([state.total_stat] if _args.summary else []):
         cells: List[str] = []
 
         for f in field_keys:
@@ -283,6 +740,31 @@ def print_csv(state: State, sorted_dirs: List[Stat], stopwatch: timedelta):
 
         print_row(cells)
 
+    if state.ext_stats:
+        print_gap()
+        print_row(['extension'] + list(_fields.keys()))
+
+        from disk_usage_formats import ext_rows
+
+        for row in ext_rows(state, _fields):
+            print_row(list(row.values())[:-1])
+
+    from disk_usage_formats import file_rows
+
+    for (k, files) in file_rows(state).items():
+        print_gap()
+        print_row([k, *files[0].keys()])
+
+        for f in files:
+            print_row(['', *f.values()])
+
+    if state.filter_hits:
+        print_gap()
+        print_row(['filter', 'removed'])
+
+        for (option, hits) in state.filter_hits.items():
+            print_row([option, hits])
+
     if state.has_errors:
         print_gap()
         print_row(['key', 'error'])
@@ -292,37 +774,212 @@ def print_csv(state: State, sorted_dirs: List[Stat], stopwatch: timedelta):
             for ke in errors[k]:
                 print_row([k, ke])
 
+            if state.unsampled_errors(k):
+                print_row([k, f'... {state.unsampled_errors(k)} more'])
+
     if _args.timed:
         print_gap()
         print_row(['Seek time', stopwatch.total_seconds()])
+        print_row(['Syscalls', state.counters.syscalls])
+        print_row(['Syscalls per file', round(state.counters.syscalls_per_file, 2)])
+        print_row(['Files per second', round(state.counters.files / max(stopwatch.total_seconds(), 1e-9))])
+        print_row(['Syscalls per second', round(state.counters.syscalls / max(stopwatch.total_seconds(), 1e-9))])
 
+        if state.counters.throttle_wait_ns:
+            print_row(['Throttle wait', state.counters.throttle_wait_ns / 1e9])
 
-def print_grid(grid: Grid, sorted_dirs: List[Stat], total_dir: Stat):
+        if _cache:
+            print_row(['Cache hit rate', round(state.counters.cache_hit_rate, 4)])
+
+
+def display_width(s: str) -> int:
+    s = _ansi_escape.sub('', s)
+
+    if s.isascii():
+        return len(s)
+
+    return sum([0 if unicodedata.combining(c) else 2 if unicodedata.east_asian_width(c) in 'WF' else 1 for c in s])
+
+
+def render_columns(headers: List[str], rows: List[List[str]], alignments: List[str], left_padding: int, right_padding: int) -> str:
+    """Lays out like PrettyTable's PLAIN_COLUMNS style without importing it, wcwidth alone costs more than a small scan"""
+    widths = [max([display_width(c) for c in col]) for col in zip(headers, *rows)]
+    lines: List[str] = []
+
+    for row in [headers] + rows:
+        cells: List[str] = []
+
+        for (c, w, a) in zip(row, widths, alignments):
+            pad = ' ' * (w - display_width(c))
+            cells.append(' ' * left_padding + (pad + c if a == 'r' else c + pad) + ' ' * right_padding)
+
+        lines.append(''.join(cells))
+
+    return '\n'.join(lines)
+
+
+def render_grid(grid: Grid, sorted_dirs: List[Stat], total_dir: Stat, name_title: str = _name_field) -> str:
     max_count_len = len(human_int(total_dir.file_count))
 
     grid.additional_fields['count'].width = max_count_len + grid.int_field_padding
+    # Laid out again on every render, the count width grows while --live rows arrive
+    grid.remove_field(_name_field)
+    grid.remove_field(_ext_name_field)
 
     while grid.remaining_width(grid.field_padding) <= _name_min_width:
         grid.remove_last_field()
 
     name_max_width = grid.remaining_width() - grid.field_padding
-    grid.add_field(Field('Folder', 'l', lambda f, d: color_field(f, d, truncate(d.name, name_max_width, True)), name_max_width))
+    grid.add_field(Field(name_title, 'l', lambda f, d: color_field(f, d, truncate(d.name, name_max_width, True)), name_max_width))
 
     dirs = [[f.get_value(f, d) for f in grid.fields] for d in sorted_dirs]
     dirs.append([f'{ShellColors.Bold}{f.get_value(f, total_dir)}{ShellColors.Off}' for f in grid.fields])
 
-    pt = PrettyTable([f.name for f in grid.fields])
-    pt.set_style(PLAIN_COLUMNS)
-    pt.border = False
-    pt.padding_width = 0
-    pt.left_padding_width = grid.field_left_padding_width
-    pt.right_padding_width = grid.field_right_padding_width
-    pt.add_rows(dirs)
+    return render_columns([f.name for f in grid.fields], dirs, [f.alignment for f in grid.fields],
+                          grid.field_left_padding_width, grid.field_right_padding_width)
+
+
+def print_grid(grid: Grid, sorted_dirs: List[Stat], total_dir: Stat):
+    print(render_grid(grid, sorted_dirs, total_dir))
+
+
+def print_ext_grid(grid: Grid, state: State, sorter: Callable[[Stat], Any]) -> None:
+    by_size = sorted(state.ext_stats.values(), key=lambda e: e.size, reverse=True)
+    rows: List[Stat] = [ext_display(e) for e in by_size[:_ext_grid_rows]]
+    total = BareStat('Total')
+
+    for e in by_size:
+        total.merge(e)
+
+    if len(by_size) > _ext_grid_rows:
+        other = BareStat(f'({human_int(len(by_size) - _ext_grid_rows)} more)')
+
+        for e in by_size[_ext_grid_rows:]:
+            other.merge(e)
+
+        rows.append(other)
+
+    print('')
+    print(render_grid(grid, sorted(rows, key=sorter, reverse=_args.sort_reversed), total, _ext_name_field))
+
+
+def ext_display(e: BareStat) -> BareStat:
+    if e.name:
+        return e
+
+    none = BareStat('(none)')
+    none.merge(e)
+
+    return none
+
+
+class LiveGrid:
+    """Redraws the grid in place as rows stream in from collect_sizes_*"""
+    _grid: Grid
+    _state: State
+    _sorter: Callable[[Stat], Any]
+    _lines: int
+    _last_draw: float
+
+    def __init__(self, grid: Grid, state: State, sorter: Callable[[Stat], Any]) -> None:
+        self._grid = grid
+        self._state = state
+        self._sorter = sorter
+        self._lines = 0
+        self._last_draw = 0
+
+    # noinspection PyUnusedLocal
+    def on_row(self, row: Stat, complete: bool) -> None:
+        if complete or time.monotonic() - self._last_draw >= _live_redraw_interval:
+            self.draw()
+
+    def draw(self) -> None:
+        rows = sorted(self._state.dirs, key=self._sorter, reverse=_args.sort_reversed)
+        # Header and total take two lines, keep the frame inside the terminal so the cursor can get back to its top
+        max_rows = max(shutil.get_terminal_size().lines - 3, 1)
+
+        if len(rows) > max_rows:
+            rows = rows[-max_rows:] if not _args.sort_reversed else rows[:max_rows]
+
+        frame = render_grid(self._grid, rows, self._state.total_stat)
+
+        if self._lines:
+            sys.stdout.write(f'\033[{self._lines}F\033[J')
+
+        sys.stdout.write(frame + '\n')
+        sys.stdout.flush()
+        self._lines = frame.count('\n') + 1
+        self._last_draw = time.monotonic()
+
+    def clear(self) -> None:
+        if self._lines:
+            sys.stdout.write(f'\033[{self._lines}F\033[J')
+            sys.stdout.flush()
+            self._lines = 0
+
+
+def print_files(state: State) -> None:
+    if state.largest_files:
+        print(f'\n{ShellColors.Bold}Largest files:{ShellColors.Off}')
+
+        for (size, p) in sorted(state.largest_files, reverse=True):
+            print(f'{pretty_size(size):>{_size_field_width + 2}}  {state.get_relative_path(Path(p))}')
+
+    if state.newest_files:
+        print(f'\n{ShellColors.Bold}Newest files:{ShellColors.Off}')
+
+        for (mtime_ns, p) in sorted(state.newest_files, reverse=True):
+            print(f'  {datetime.fromtimestamp(mtime_ns / 1e9):%Y-%m-%d %H:%M}  {state.get_relative_path(Path(p))}')
+
+
+def print_diff(state: State, snapshot_root: str, total: Union['DiffRow', None], rows: List['DiffRow']) -> None:
+    from disk_usage_formats import NdjsonWriter, print_diff_json, print_diff_tsv
+    from disk_usage_snapshot import DiffRow
+
+    if _args.format == 'json':
+        print_diff_json(state.root.as_posix(), snapshot_root, total, rows)
+        return
+    elif _args.format == 'tsv':
+        print_diff_tsv(total, rows)
+        return
+    elif _args.format == 'ndjson':
+        writer = NdjsonWriter(_fields)
+
+        for r in rows:
+            writer.write('diff', r._asdict())
+
+        if total:
+            writer.write('total', total._asdict())
+        return
+    elif _args.format == 'csv':
+        for r in [DiffRow._fields] + rows + ([total] if total else []):
+            print(','.join([f'"{str(c)}"' for c in r]))
+        return
+
+    def signed_size(size: int) -> str:
+        return f'{"+" if size >= 0 else "-"}{pretty_size(abs(size))}'
+
+    def signed_int(i: int) -> str:
+        return f'{"+" if i >= 0 else "-"}{human_int(abs(i))}'
+
+    if snapshot_root != state.root.as_posix():
+        _log.warn(f'Snapshot was taken of {snapshot_root}')
+
+    table: List[List[str]] = []
+
+    for r in rows:
+        color = ShellColors.Red if r.size_delta > 0 else ShellColors.Green
+        table.append([f'{color}{signed_size(r.size_delta)}{ShellColors.Off}', signed_int(r.count_delta), pretty_size(r.size), r.status, r.path])
 
-    for fld in grid.fields:
-        pt.align[fld.name] = fld.alignment
+    if total:
+        table.append([f'{ShellColors.Bold}{signed_size(total.size_delta)}{ShellColors.Off}', signed_int(total.count_delta), pretty_size(total.size), '',
+                      f'{ShellColors.Bold}Total{ShellColors.Off}'])
 
-    print(pt)
+    if not table:
+        print('No changes')
+        return
+
+    print(render_columns(['Growth', 'Files', 'Size', 'Status', _name_field], table, ['r', 'r', 'r', 'l', 'l'], 0, 2))
 
 
 def prep_grid(max_name_len: int) -> Grid:
@@ -333,7 +990,11 @@ def prep_grid(max_name_len: int) -> Grid:
     grid.additional_fields = {
         'density': Field('Density', 'r', lambda f, d: color_field(f, d, pretty_size(d.density)), _size_field_width + grid.int_field_padding, ShellColors.Cyan),
         'count': Field('Count', 'r', lambda f, d: color_field(f, d, human_int(d.file_count)), _size_field_width + grid.int_field_padding),
-        'max': Field('Max', 'r', lambda f, d: color_field(f, d, pretty_size(d.max_size)), _size_field_width + grid.int_field_padding)
+        'max': Field('Max', 'r', lambda f, d: color_field(f, d, pretty_size(d.max_size)), _size_field_width + grid.int_field_padding),
+        'p50': Field('P50', 'r', lambda f, d: color_field(f, d, pretty_size(d.percentile(50))), _size_field_width + grid.int_field_padding),
+        'p90': Field('P90', 'r', lambda f, d: color_field(f, d, pretty_size(d.percentile(90))), _size_field_width + grid.int_field_padding),
+        'p99': Field('P99', 'r', lambda f, d: color_field(f, d, pretty_size(d.percentile(99))), _size_field_width + grid.int_field_padding),
+        _hist_field: Field('0B…4G+', 'l', lambda f, d: color_field(f, d, d.sparkline), 12)
     }
 
     if _args.sort and _args.sort != 'size':
@@ -355,19 +1016,176 @@ def prep_grid(max_name_len: int) -> Grid:
         else:
             name_allocation = max_name_len
 
-        for fld in grid.additional_fields.values():
+        for fld in [grid.additional_fields[k] for k in _auto_fields]:
             if grid.can_fit_field(fld, name_allocation):
                 grid.add_field(fld)
 
     return grid
 
 
+def slowest_imports(limit: int) -> List[Tuple[str, int]]:
+    """Cumulative microseconds of the modules disk_usage imports directly, from a fresh interpreter"""
+    import subprocess
+
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([os.path.dirname(os.path.abspath(__file__)), os.environ.get('PYTHONPATH', '')]))
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import disk_usage'], env=env, capture_output=True, text=True)
+    res: List[Tuple[str, int]] = []
+
+    for line in proc.stderr.splitlines():
+        parts = line.split('|')
+
+        # Each level of nesting indents the name by two more spaces, one level in are disk_usage's own imports
+        if len(parts) == 3 and parts[0].startswith('import time:') and parts[2].startswith('   ') and not parts[2].startswith('    ') \
+                and parts[1].strip().isdigit():
+            res.append((parts[2].strip(), int(parts[1])))
+
+    return sorted(res, key=lambda r: r[1], reverse=True)[:limit]
+
+
+def print_startup_profile() -> None:
+    rows: List[Tuple[str, float]] = [('imports', _imports_done - _import_start)]
+    last = _imports_done
+
+    for (phase, stamp) in _phases.items():
+        rows.append((phase, stamp - last))
+        last = stamp
+
+    rows.append(('total', last - _import_start))
+    out = [f'{ShellColors.Green}Startup profile:{ShellColors.Off}'] + [f'  {k:<10}{v * 1000:>8.1f}ms' for (k, v) in rows]
+    out.append(f'{ShellColors.Green}Slowest imports:{ShellColors.Off}')
+    out += [f'  {name:<24}{us / 1000:>8.1f}ms' for (name, us) in slowest_imports(_profiled_imports)]
+
+    print('\n'.join(out), file=sys.stderr)
+
+
+def print_results(state: State, st: timedelta, grid: Union[Grid, None], sorter: Callable[[Stat], Any], ndjson: Union['NdjsonWriter', None]) -> None:
+    if state.root_stat.size > 0:
+        state.add_dir(state.root_stat)
+
+        if ndjson and not _args.summary:
+            ndjson.row(state.root_stat)
+
+    if ndjson:
+        ndjson.finish(state, st, _args.timed, _cache is not None)
+        return
+
+    if _args.summary:
+        sorted_dirs = []
+    elif _args.depth > 1:
+        # Largest first reads better once children are listed under their parent
+        sorted_dirs = tree_rows(state, sorted(state.dirs, key=sorter, reverse=not _args.sort_reversed), sorter)
+    else:
+        sorted_dirs = sorted(state.dirs, key=sorter, reverse=_args.sort_reversed)
+    if _args.format == 'csv':
+        print_csv(state, sorted_dirs, st)
+    elif _args.format == 'json':
+        from disk_usage_formats import print_json
+        print_json(state, sorted_dirs, st, _fields, _args.timed, _cache is not None)
+    elif _args.format == 'tsv':
+        from disk_usage_formats import print_tsv
+        print_tsv(state, sorted_dirs, st, _fields, _args.timed, _cache is not None)
+    else:
+        print_grid(grid, sorted_dirs, state.total_stat)
+
+        if state.ext_stats:
+            print_ext_grid(grid, state, sorter)
+
+        print_files(state)
+
+        if state.filter_hits:
+            print(f'\nFiltered out: {", ".join([f"{human_int(n)} by {k}" for (k, n) in state.filter_hits.items()])}')
+
+        if state.has_errors:
+            print('')
+            errors = state.get_errors()
+            for k in errors:
+                more = state.unsampled_errors(k)
+
+                if more:
+                    errors[k].append(f'... {human_int(more)} more' + (f', all in {_args.error_log.as_posix()}' if _args.error_log else ''))
+
+                print(f'{ShellColors.Red}{k}:{ShellColors.Off}\n\t{"\n\t".join(errors[k])}')
+
+        if _args.timed:
+            print(ShellColors.Green)
+            print(f'Seek time: {st.total_seconds()}')
+            print(f'Syscalls:  {human_int(state.counters.syscalls)} ({state.counters.syscalls_per_file:.2f}/file)')
+            seconds = max(st.total_seconds(), 1e-9)
+            rate = f'Rate:      {human_int(round(state.counters.files / seconds))} files/s, {human_int(round(state.counters.syscalls / seconds))} syscalls/s'
+
+            if _args.throttle:
+                # Wait is summed over threads, it can exceed the seek time
+                rate += f' (capped at {human_int(_args.max_iops)}/s, {state.counters.throttle_wait_ns / 1e9:.1f}s waited)'
+
+            print(rate)
+
+            if _cache:
+                looked_up = state.counters.cache_hits + state.counters.cache_misses
+                print(f'Cache:     {state.counters.cache_hit_rate:.1%} hit ({human_int(state.counters.cache_hits)}/{human_int(looked_up)} dirs)')
+
+            print(ShellColors.Off, end='')
+
+
+def agent_args() -> List[str]:
+    """Flags changing what the agents count, passed on to each of them"""
+    args = [flag for (flag, on) in (('-eh', _args.exclude_hidden), ('-du', _args.disk_usage), ('--dedupe-inodes', _args.dedupe_inodes),
+                                    ('--no-cache', _args.no_cache), ('--refresh', _args.refresh), ('--nice', _args.nice),
+                                    ('--trace', _args.trace)) if on]
+
+    if _args.max_iops:
+        args += ['--max-iops', str(_args.max_iops)]
+
+    for (flag, rx) in (('-ff', _args.file_filter), ('-df', _args.directory_filter), ('-pf', _args.path_filter)):
+        if rx is not None:
+            args += [flag, rx.pattern]
+
+    if _args.glob:
+        args += ['--glob', _args.glob]
+
+    # Last, -e takes every argument after it
+    if _args.exclude:
+        args += ['-e'] + _args.exclude
+
+    return args
+
+
+def scan_remote(sorter: Callable[[Stat], Any]) -> None:
+    from disk_usage_remote import collect_remote
+
+    # Rows are named host:folder, errors keep the host:path the agent reported them under
+    state = State(Path(''), Dir('./'), BareStat('Total'))
+    ndjson: Union['NdjsonWriter', None] = None
+    on_row: RowCallback = None
+
+    if _args.format == 'ndjson':
+        from disk_usage_formats import NdjsonWriter
+        ndjson = NdjsonWriter(_fields)
+
+        def on_row(row: Stat, complete: bool) -> None:
+            if complete and not _args.summary:
+                ndjson.row(row)
+
+    st: datetime = datetime.now()
+    collect_remote(state, _args.targets, _args.remote_cmd, agent_args(), on_row)
+    st: timedelta = datetime.now() - st
+    _phases['scan'] = time.perf_counter()
+
+    grid: Grid = prep_grid(max([len(d.name) for d in state.dirs], default=0)) if _args.format == 'grid' else None
+    print_results(state, st, grid, sorter, ndjson)
+
+
 def main():
-    global _args
+    global _args, _cache, _log
 
     try:
         _args = Args().parse_args()
-        state = State(_args.root.resolve(), BareStat('./'), BareStat('Total'))
+        _phases['args'] = time.perf_counter()
+
+        if _args.nice and not _args.targets:
+            from disk_usage_throttle import lower_priority
+            lower_priority(_log)
+
+        state = State(_args.root.resolve(), Dir('./'), BareStat('Total'), max(_args.top_files, 0), max(_args.newest, 0), _args.error_log)
 
         sorter: Callable[[Stat], Any]
 
@@ -377,56 +1195,150 @@ def main():
             print(f'Invalid sort argument {_args.sort}')
             exit(1)
 
+        if _args.targets:
+            scan_remote(sorter)
+            return
+
+        agent: Union['AgentWriter', None] = None
+
+        if _args.serve:
+            from disk_usage_remote import AgentWriter, claim_stdout
+            agent = AgentWriter(claim_stdout(), state.root)
+
+        # Cached records only hold per directory totals, these options need to see every file. Snapshots and diffs are
+        # after files that grew in place, which leave the mtime of their directory, and so the cache, untouched
+        if (not _args.no_cache and not _args.dedupe_inodes and not state.tracks_files and not _args.by_ext and not _args.filters
+                and not _args.snapshot and not _args.diff):
+            cache_path = cache_file(state.root, f'exclude_hidden={_args.exclude_hidden}', f'disk_usage={_args.disk_usage}')
+
+            if cache_path:
+                _cache = load_cache(cache_path, _args.refresh)
+                _log.trace(f'Loaded {_cache.size} cached dirs from {cache_path.as_posix()}')
+            else:
+                _log.trace('ZSHCOM__transient not set, scan cache disabled')
+
         st: datetime = datetime.now()
 
         max_name_len = 0
-        root_dirs: List[Path] = []
-        root_files: List[Path] = []
-
-        for fso in _args.root.iterdir():
-            if fso.is_dir():
-                if not exclude_dir(fso, _args):
-                    root_dirs.append(fso)
-                    name_len = len(fso.name)
+        root_dirs: List[WorkItem] = []
+        root_files: List[os.DirEntry] = []
+
+        root_st = os.stat(state.root)
+        root_dev = root_st.st_dev
+
+        if _args.disk_usage:
+            state.root_stat.add_size(root_st.st_blocks * 512)
+        with os.scandir(state.root) as root_it:
+            root_entries = list(root_it)
+        state.counters.listings += 1
+        state.counters.stats += 1
+
+        for entry in root_entries:
+            if entry.is_dir():
+                if filter_dir(entry.name, entry.path, state, _args, top=True):
+                    continue
+
+                state.counters.stats += 1
+                est = entry.stat(follow_symlinks=False)
+
+                if entry.is_symlink() or est.st_dev != root_dev:
+                    # ToDo: Make warning/log
+                    state.error('Excluded', Path(entry.path))
+                elif not exclude_dir(entry.path, est, state, _args):
+                    root_dirs.append((entry.path, est.st_dev, est.st_ino, est.st_mtime_ns, est.st_blocks))
+                    name_len = len(entry.name)
                     if name_len > max_name_len:
                         max_name_len = name_len
-                else:
-                    # ToDo: Make warning/log
-                    state.error('Excluded', fso)
-            elif fso.is_file():
-                root_files.append(fso)
+            elif entry.is_file(follow_symlinks=False):
+                root_files.append(entry)
+
+        grid: Grid = prep_grid(max_name_len) if _args.format == 'grid' else None
+        live: Union[LiveGrid, None] = LiveGrid(grid, state, sorter) if grid and _args.live and not _args.diff and sys.stdout.isatty() else None
+        ndjson: Union['NdjsonWriter', None] = None
+
+        if _args.format == 'ndjson' and not _args.diff:
+            from disk_usage_formats import NdjsonWriter
+            ndjson = NdjsonWriter(_fields)
 
-        grid: Grid = prep_grid(max_name_len) if not _args.csv else None
+        on_row: RowCallback = live.on_row if live else agent.row if agent else None
 
-        if _args.threads == 1:
-            collect_sizes_single(state, root_dirs, root_files)
-        elif _args.threads > 1:
-            collect_sizes_parallel(state, root_dirs, root_files)
+        if ndjson and not _args.summary:
+            def on_row(row: Stat, complete: bool) -> None:
+                if complete:
+                    ndjson.row(row)
+
+                    if _args.depth > 1:
+                        for sub in subtree_rows(state, row, sorter):
+                            ndjson.row(sub)
+
+        if _args.workers == 1:
+            collect_sizes_single(state, root_dirs, root_files, on_row)
+        elif _args.workers > 1:
+            collect_sizes_parallel(state, root_dirs, root_files, on_row)
         else:
             _log.error('Threads must be 1 or greater.')
             exit(1)
         st: timedelta = datetime.now() - st
+        _phases['scan'] = time.perf_counter()
 
-        if state.root_stat.size > 0:
-            state.add_dir(state.root_stat)
+        if live:
+            live.clear()
 
-        sorted_dirs = sorted(state.dirs, key=sorter, reverse=_args.sort_reversed)
-        if _args.csv:
-            print_csv(state, sorted_dirs, st)
-        else:
-            print_grid(grid, sorted_dirs, state.total_stat)
+        for rule in _args.excluder.rules:
+            _log.trace(f'Exclusion {rule}: {human_int(state.exclusion_hits.get(rule, 0))} folders')
 
-            if state.has_errors:
-                print('')
-                errors = state.get_errors()
-                for k in errors:
-                    print(f'{ShellColors.Red}{k}:{ShellColors.Off}\n\t{"\n\t".join(errors[k])}')
+        if _cache:
+            _cache.save(state.dir_records)
 
-            if _args.timed:
-                print(ShellColors.Green)
-                print(f'Seek time: {st.total_seconds()}{ShellColors.Off}')
+        if agent:
+            agent.finish(state, st.total_seconds())
+            return
+
+        if _args.snapshot or _args.diff:
+            from disk_usage_tree import CompactTree
+            from disk_usage_snapshot import snapshot_rows, write_snapshot, diff_snapshot
+
+            top_paths = [(state.root / d.name).as_posix() for d in state.dirs]
+            tree = CompactTree.from_records(state.root.as_posix(), state.root_stat, top_paths, state.dir_records)
+            rows = snapshot_rows(tree, state.dir_records, root_st.st_ino, root_st.st_mtime_ns)
+
+            if _args.diff:
+                try:
+                    (snapshot_root, total, growth) = diff_snapshot(_args.diff, rows, _args.depth, _args.diff_limit, _args.sort_reversed)
+                except (ValueError, struct.error) as e:
+                    _log.error(f'Unable to read snapshot {_args.diff.as_posix()}: {e}')
+                    exit(1)
+
+            if _args.snapshot:
+                write_snapshot(_args.snapshot, state.root.as_posix(), rows)
+                _log.trace(f'Saved {human_int(len(rows))} dirs to {_args.snapshot.as_posix()}')
+
+            if _args.diff:
+                # noinspection PyUnboundLocalVariable
+                print_diff(state, snapshot_root, total, growth)
+                return
+
+        if _args.browse:
+            from disk_usage_tree import CompactTree
+            from disk_usage_browser import browse
+
+            top_paths = [(state.root / d.name).as_posix() for d in state.dirs]
+            tree = CompactTree.from_records(state.root.as_posix(), state.root_stat, top_paths, state.dir_records)
+            state.dir_records = {}
+            # Rescans always hit the disk and must not trace into the curses screen
+            _cache = None
+            _log = Logger(disable_log_color=True)
+            # The tree keeps no histograms, percentile sorts fall back to size
+            browse(tree, _fields, _args.sort if _args.sort in _auto_fields else 'size', rescan_subtree)
+            return
+
+        print_results(state, st, grid, sorter, ndjson)
     except KeyboardInterrupt:
         exit(0)
+    finally:
+        if 'args' in _phases and _args.profile_startup:
+            _phases['output'] = time.perf_counter()
+            print_startup_profile()
 
 
 if __name__ == '__main__':
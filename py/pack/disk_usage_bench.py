@@ -0,0 +1,282 @@
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import List, Dict, Callable, Any, Union
+
+from prettytable import PrettyTable, PLAIN_COLUMNS
+
+from cli_args import BaseTap
+from utils import human_int, pretty_size, ShellColors
+from disk_usage_models import State, Dir, BareStat
+
+
+class Args(BaseTap):
+    threads: List[int]
+    scale: float = 1.0
+    repeat: int = 3
+    seed: int = 1
+    shapes: List[str]
+    baseline: Path = Path.home() / '.duh_bench.json'
+    save_baseline: bool
+    threshold: float = 0.2
+    keep: bool
+
+    def configure(self) -> None:
+        self.description = 'Benchmark duh on reproducible synthetic trees'
+        self.add_multi('-th', '--threads', help='Thread counts to run, 1 is the single threaded mode', type=int, default=[1, 2, 4])
+        self.add_optional('--scale', help='Multiplier on the number of files in every shape', type=float, default=1.0)
+        self.add_optional('--repeat', help='Runs per case, the fastest is kept', type=int, default=3)
+        self.add_optional('--seed', help='Seed for the tree generator', type=int, default=1)
+        self.add_multi_choice('--shapes', help='Shapes to generate', choices=list(_shapes.keys()), default=None)
+        self.add_optional('--baseline', help='Baseline file to compare against', type=Path, default=Path.home() / '.duh_bench.json')
+        self.add_flag('--save-baseline', help='Store this run as the baseline instead of comparing')
+        self.add_optional('--threshold', help='Allowed throughput drop against the baseline before failing', type=float, default=0.2)
+        self.add_flag('--keep', help="Don't delete the generated trees")
+
+    def process_args(self) -> None:
+        if not self.shapes:
+            self.shapes = list(_shapes.keys())
+
+
+_args: Args
+
+
+# region tree shapes
+
+def _write_files(d: Path, count: int, rnd: random.Random, max_exp: int = 20) -> None:
+    d.mkdir(parents=True, exist_ok=True)
+
+    for i in range(count):
+        # Sparse files, the sizes are real but nothing is written
+        with (d / f'f{i}.bin').open('wb') as f:
+            f.truncate(int(2 ** rnd.uniform(0, max_exp)))
+
+
+def _wide(root: Path, n: int, rnd: random.Random) -> None:
+    for i in range(max(n // 10, 1)):
+        _write_files(root / f'top{i % 20}' / f'd{i}', 10, rnd)
+
+
+def _deep(root: Path, n: int, rnd: random.Random) -> None:
+    d = root
+
+    for i in range(max(n // 20, 1)):
+        d = d / f'l{i % 10}'
+        _write_files(d, 20, rnd)
+
+
+def _giant(root: Path, n: int, rnd: random.Random) -> None:
+    _write_files(root / 'media' / 'giant', n, rnd, 34)
+    _write_files(root / 'small', 10, rnd)
+
+
+def _tiny(root: Path, n: int, rnd: random.Random) -> None:
+    for i in range(max(n // 100, 1)):
+        _write_files(root / f'top{i % 8}' / f'd{i}', 100, rnd, 10)
+
+
+def _symlinks(root: Path, n: int, rnd: random.Random) -> None:
+    _wide(root, n // 2, rnd)
+
+    for i in range(max(n // 20, 1)):
+        link_dir = root / f'top{i % 20}'
+        link_dir.mkdir(parents=True, exist_ok=True)
+        # Loops back to the root, the walker must not follow it
+        (link_dir / f'loop{i}').symlink_to(root, target_is_directory=True)
+        (link_dir / f'file_link{i}').symlink_to(link_dir / f'loop{i}')
+
+
+def _denied(root: Path, n: int, rnd: random.Random) -> None:
+    _wide(root, n // 2, rnd)
+
+    for i in range(max(n // 200, 1)):
+        d = root / f'top{i % 20}' / f'denied{i}'
+        _write_files(d, 10, rnd)
+        # Has no effect when benchmarking as root
+        d.chmod(0)
+
+
+def remove_tree(base: Path) -> None:
+    # Denied dirs have to be opened back up before they can be removed. walk can't list them, so each is opened
+    # while still in dirnames, before the walk descends into it
+    for (d, dirs, _) in os.walk(base):
+        for name in dirs:
+            path = os.path.join(d, name)
+
+            # chmod follows symlinks, the loops of the symlinks shape point back into the tree
+            if not os.path.islink(path):
+                os.chmod(path, 0o755)
+
+    shutil.rmtree(base, ignore_errors=True)
+
+
+_shapes: Dict[str, Callable[[Path, int, random.Random], None]] = {
+    'wide': _wide,
+    'deep': _deep,
+    'giant': _giant,
+    'tiny': _tiny,
+    'symlinks': _symlinks,
+    'denied': _denied,
+}
+_base_files = 20000
+
+
+def generate(base: Path, shape: str, scale: float, seed: int) -> Path:
+    root = base / shape
+    _shapes[shape](root, max(int(_base_files * scale), 1), random.Random(f'{seed}:{shape}'))
+
+    return root
+
+# endregion
+
+
+def run_duh(root: Path, threads: int) -> Dict[str, Any]:
+    cmd = [sys.executable, *[f'-W{w}' for w in sys.warnoptions], Path(__file__).with_name('disk_usage.py').as_posix(), root.as_posix(),
+           '--format', 'json', '--timed', '--no-cache', '--measure-ipc', '-th', str(threads)]
+    env = dict(os.environ, ZSHCOM__cpu_cores=str(os.cpu_count() or 1))
+
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, env=env)
+    out = proc.stdout.read()
+    # wait4 hands back the rusage of this run alone, ru_maxrss covers the pool workers it waited on too
+    (_, status, usage) = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+
+    if proc.returncode != 0:
+        raise Exception(f'duh exited with {proc.returncode}: {" ".join(cmd)}')
+
+    doc = json.loads(out)
+    seek_time = doc['timing']['seek_time']
+
+    return {
+        'files': doc['total']['count'],
+        'seek_time': seek_time,
+        'files_per_sec': doc['total']['count'] / seek_time if seek_time > 0 else 0.0,
+        'peak_rss': usage.ru_maxrss * 1024,
+        'ipc_bytes': doc['timing'].get('ipc_bytes', 0)
+    }
+
+
+def bench_merge(tasks: int = 20000) -> Dict[str, Any]:
+    """State.merge in isolation, the parent runs it once per pool result"""
+    root = Path('/bench')
+    state = State(root, Dir('./'), BareStat('Total'))
+    task_states: List[State] = []
+
+    for i in range(tasks):
+        ts = state.task_state(root)
+        dr = Dir(f'top{i % 50}')
+
+        for s in range(20):
+            dr.add_file(s * 1000 + i)
+
+        # Denied folders pile up on shares, merging them has to stay cheap
+        for e in range(5):
+            ts.error('Permission denied in', root / dr.name / f'denied{i}_{e}')
+
+        ts.add_dir(dr)
+        task_states.append(ts)
+
+    st = time.perf_counter()
+
+    for ts in task_states:
+        state.merge(ts)
+
+    elapsed = time.perf_counter() - st
+
+    return {'merges': tasks, 'seek_time': elapsed, 'merges_per_sec': tasks / elapsed if elapsed > 0 else 0.0}
+
+
+def check_regressions(results: Dict[str, Dict[str, Any]], baseline: Dict[str, Dict[str, Any]]) -> List[str]:
+    regressions: List[str] = []
+
+    for (case, res) in results.items():
+        base = baseline.get(case)
+        metric = 'merges_per_sec' if 'merges_per_sec' in res else 'files_per_sec'
+
+        if base is None or metric not in base:
+            continue
+
+        floor = base[metric] * (1 - _args.threshold)
+
+        if res[metric] < floor:
+            regressions.append(f'{case}: {res[metric]:,.0f} {metric} < {floor:,.0f} ({base[metric]:,.0f} baseline -{_args.threshold:.0%})')
+
+    return regressions
+
+
+def print_results(results: Dict[str, Dict[str, Any]], baseline: Dict[str, Dict[str, Any]]) -> None:
+    pt = PrettyTable(['Case', 'Files', 'Seconds', 'Files/s', 'Baseline', 'Peak RSS', 'IPC'])
+    pt.set_style(PLAIN_COLUMNS)
+
+    for (case, res) in results.items():
+        metric = 'merges_per_sec' if 'merges_per_sec' in res else 'files_per_sec'
+        base: Union[float, None] = baseline.get(case, {}).get(metric)
+        pt.add_row([
+            case,
+            human_int(res.get('files', res.get('merges', 0))),
+            f'{res["seek_time"]:.3f}',
+            f'{res[metric]:,.0f}',
+            f'{res[metric] / base - 1:+.1%}' if base else '',
+            pretty_size(res['peak_rss']) if 'peak_rss' in res else '',
+            pretty_size(res['ipc_bytes']) if res.get('ipc_bytes') else ''
+        ])
+
+    for fld in pt.field_names:
+        pt.align[fld] = 'l' if fld == 'Case' else 'r'
+
+    print(pt)
+
+
+def main():
+    global _args
+
+    _args = Args().parse_args()
+    base = Path(tempfile.mkdtemp(prefix='duh_bench_'))
+    results: Dict[str, Dict[str, Any]] = {}
+
+    try:
+        for shape in _args.shapes:
+            print(f'Generating {shape}...', file=sys.stderr)
+            root = generate(base, shape, _args.scale, _args.seed)
+
+            for threads in _args.threads:
+                runs = [run_duh(root, threads) for _ in range(_args.repeat)]
+                results[f'{shape}/th{threads}'] = max(runs, key=lambda r: r['files_per_sec'])
+
+        results['state_merge'] = max([bench_merge() for _ in range(_args.repeat)], key=lambda r: r['merges_per_sec'])
+    finally:
+        if not _args.keep:
+            remove_tree(base)
+        else:
+            print(f'Trees kept in {base.as_posix()}', file=sys.stderr)
+
+    baseline: Dict[str, Dict[str, Any]] = {}
+
+    if _args.baseline.exists():
+        with _args.baseline.open() as f:
+            baseline = json.load(f)
+
+    print_results(results, baseline if not _args.save_baseline else {})
+
+    if _args.save_baseline:
+        with _args.baseline.open('w') as f:
+            json.dump(results, f, indent=2)
+
+        print(f'{ShellColors.Green}Baseline saved to {_args.baseline.as_posix()}{ShellColors.Off}')
+        return
+
+    regressions = check_regressions(results, baseline)
+
+    if regressions:
+        print(f'{ShellColors.Red}Throughput regressed:{ShellColors.Off}\n\t' + '\n\t'.join(regressions))
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
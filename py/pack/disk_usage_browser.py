@@ -0,0 +1,212 @@
+import curses
+import queue
+import threading
+from typing import Dict, Callable, Any, List, Tuple, Union
+
+from utils import pretty_size, human_int, truncate
+from disk_usage_models import Stat, DirRecord
+from disk_usage_tree import CompactTree, NodeStat
+
+# Takes the absolute path of a directory and walks it again, returns its fresh records and the number of errors hit
+Rescan = Callable[[str], Tuple[Dict[str, DirRecord], int]]
+
+_sort_keys: Dict[int, str] = {ord('s'): 'size', ord('c'): 'count', ord('d'): 'density', ord('m'): 'max'}
+_bar_width = 10
+_poll_ms = 250
+_help = 'enter/→ open  ←/bksp up  s/c/d/m sort  r reverse  R rescan  q quit'
+
+
+class _Browser:
+    _tree: CompactTree
+    _fields: Dict[str, Callable[[Stat], Any]]
+    _rescan: Rescan
+    _cwd: int
+    _selected: int
+    _offset: int
+    _sort: str
+    _reversed: bool
+    _rows: Union[List[NodeStat], None]
+    _rescanning: Dict[int, str]
+    _rescanned: queue.SimpleQueue
+    _status: str
+
+    def __init__(self, tree: CompactTree, fields: Dict[str, Callable[[Stat], Any]], sort: str, rescan: Rescan) -> None:
+        self._tree = tree
+        self._fields = fields
+        self._rescan = rescan
+        self._cwd = 0
+        self._selected = 0
+        self._offset = 0
+        self._sort = sort
+        self._reversed = False
+        self._rows = None
+        self._rescanning = {}
+        self._rescanned = queue.SimpleQueue()
+        self._status = ''
+
+    def run(self, scr: curses.window) -> None:
+        curses.curs_set(0)
+        scr.timeout(_poll_ms)
+
+        if curses.has_colors():
+            curses.use_default_colors()
+            curses.init_pair(1, curses.COLOR_YELLOW, -1)
+
+        while True:
+            self._apply_rescans()
+            self._draw(scr)
+            key = scr.getch()
+
+            if key == -1:
+                continue
+            elif key in (ord('q'), 27):
+                return
+            elif key in (curses.KEY_UP, ord('k')):
+                self._move(-1)
+            elif key in (curses.KEY_DOWN, ord('j')):
+                self._move(1)
+            elif key == curses.KEY_PPAGE:
+                self._move(-self._page_size(scr))
+            elif key == curses.KEY_NPAGE:
+                self._move(self._page_size(scr))
+            elif key in (curses.KEY_ENTER, 10, 13, curses.KEY_RIGHT, ord('l')):
+                self._open()
+            elif key in (curses.KEY_LEFT, curses.KEY_BACKSPACE, 127, ord('h')):
+                self._up()
+            elif key in _sort_keys:
+                self._sort = _sort_keys[key]
+                self._rows = None
+            elif key == ord('r'):
+                self._reversed = not self._reversed
+                self._rows = None
+            elif key == ord('R'):
+                self._start_rescan()
+
+    def _rows_for_cwd(self) -> List[NodeStat]:
+        if self._rows is None:
+            rows = [self._tree.stat(c) for c in self._tree.children(self._cwd)]
+
+            if self._tree.own_count[self._cwd]:
+                rows.append(self._tree.stat(self._cwd, own=True))
+
+            # Largest first, r flips it
+            self._rows = sorted(rows, key=self._fields[self._sort], reverse=not self._reversed)
+
+        return self._rows
+
+    def _selected_row(self) -> Union[NodeStat, None]:
+        rows = self._rows_for_cwd()
+        return rows[self._selected] if rows else None
+
+    def _move(self, delta: int) -> None:
+        self._selected = max(0, min(self._selected + delta, len(self._rows_for_cwd()) - 1))
+
+    def _open(self) -> None:
+        row = self._selected_row()
+
+        if row is not None and not row.is_own_files:
+            self._cwd = row.index
+            self._selected = 0
+            self._offset = 0
+            self._rows = None
+
+    def _up(self) -> None:
+        if self._cwd == 0:
+            return
+
+        came_from = self._cwd
+        self._cwd = self._tree.parent[self._cwd]
+        self._rows = None
+        self._offset = 0
+        self._selected = next((i for i, r in enumerate(self._rows_for_cwd()) if r.index == came_from and not r.is_own_files), 0)
+
+    def _start_rescan(self) -> None:
+        row = self._selected_row()
+        i = self._cwd if row is None or row.is_own_files else row.index
+
+        if i in self._rescanning:
+            return
+
+        path = self._tree.path(i)
+        self._rescanning[i] = path
+
+        def work() -> None:
+            # noinspection PyBroadException
+            try:
+                self._rescanned.put((i, *self._rescan(path)))
+            except Exception as e:
+                self._rescanned.put((i, None, e))
+
+        threading.Thread(target=work, daemon=True).start()
+
+    def _apply_rescans(self) -> None:
+        # Splicing happens on the UI thread so the arrays are never read mid update
+        while not self._rescanned.empty():
+            (i, records, errors) = self._rescanned.get()
+            path = self._rescanning.pop(i)
+
+            if records is None:
+                self._status = f'Rescan of {path} failed: {errors}'
+                continue
+
+            self._tree.replace_subtree(i, records)
+            self._status = f'Rescanned {path}' + (f' ({human_int(errors)} errors)' if errors else '')
+
+            # The old descendants are unreachable now, pull the view back out of them
+            if self._cwd != i and self._tree.is_under(self._cwd, i):
+                self._cwd = i
+                self._selected = 0
+                self._offset = 0
+
+            self._rows = None
+
+    @staticmethod
+    def _page_size(scr: curses.window) -> int:
+        return max(scr.getmaxyx()[0] - 4, 1)
+
+    def _draw(self, scr: curses.window) -> None:
+        (height, width) = scr.getmaxyx()
+        rows = self._rows_for_cwd()
+        page = self._page_size(scr)
+        parent_size = self._tree.size[self._cwd] or 1
+
+        if self._selected < self._offset:
+            self._offset = self._selected
+        elif self._selected >= self._offset + page:
+            self._offset = self._selected - page + 1
+
+        scr.erase()
+        order = '' if not self._reversed else ' reversed'
+        header = f' {self._tree.path(self._cwd)}  {pretty_size(self._tree.size[self._cwd])} in {human_int(self._tree.count[self._cwd])} files  sort: {self._sort}{order}'
+        self._put(scr, 0, header, width, curses.A_BOLD)
+        self._put(scr, 1, f'{"Size":>9} {"Count":>11} {"Density":>9} {"Max":>9}  {"":{_bar_width}}  Folder', width, curses.A_UNDERLINE)
+
+        for (line, row) in enumerate(rows[self._offset:self._offset + page]):
+            filled = round(_bar_width * row.size / parent_size)
+            name = row.name if row.is_own_files else f'{row.name}/'
+            marker = '*' if not row.is_own_files and row.index in self._rescanning else ' '
+            text = (f'{pretty_size(row.size):>9} {human_int(row.file_count):>11} {pretty_size(row.density):>9} {pretty_size(row.max_size):>9}'
+                    f'  {"#" * filled:<{_bar_width}} {marker}{name}')
+            attr = curses.A_REVERSE if self._offset + line == self._selected else curses.A_NORMAL
+
+            if row.has_errors and curses.has_colors():
+                attr |= curses.color_pair(1)
+
+            self._put(scr, line + 2, text, width, attr)
+
+        footer = self._status or _help
+
+        if self._rescanning:
+            footer = f'rescanning {len(self._rescanning)}…  {footer}'
+
+        self._put(scr, height - 1, footer, width, curses.A_DIM)
+        scr.refresh()
+
+    @staticmethod
+    def _put(scr: curses.window, y: int, text: str, width: int, attr: int) -> None:
+        # Writing into the bottom right cell raises, stay one short of the edge
+        scr.addstr(y, 0, truncate(text, width - 1), attr)
+
+
+def browse(tree: CompactTree, fields: Dict[str, Callable[[Stat], Any]], sort: str, rescan: Rescan) -> None:
+    curses.wrapper(_Browser(tree, fields, sort, rescan).run)
@@ -0,0 +1,75 @@
+import hashlib
+import os
+import pickle
+from pathlib import Path
+from typing import Dict, Union
+
+from disk_usage_models import DirRecord
+
+# The .cache_ prefix lets magic_files.clear_cache clean these up with everything else
+_cache_file_prefix = '.cache_duh_'
+_cache_version = 2
+
+
+class ScanCache:
+    """Per directory aggregates from the last scan, a directory is only trusted while its inode and mtime are unchanged
+
+    A directory's mtime only moves when entries are added, removed or renamed, files rewritten in place are picked up by --refresh
+    """
+    path: Path
+    _entries: Dict[str, DirRecord]
+
+    def __init__(self, path: Path, entries: Dict[str, DirRecord]) -> None:
+        self.path = path
+        self._entries = entries
+
+    @property
+    def size(self) -> int:
+        return len(self._entries)
+
+    def lookup(self, path: str, ino: int, mtime_ns: int) -> Union[DirRecord, None]:
+        rec = self._entries.get(path)
+
+        if rec is not None and rec.ino == ino and rec.mtime_ns == mtime_ns and not rec.has_errors:
+            return rec
+
+        return None
+
+    def save(self, records: Dict[str, DirRecord]) -> None:
+        tmp = self.path.with_name(f'{self.path.name}.tmp')
+        # Directories with errors are left out so they get listed, and their errors reported, again next run
+        records = {k: r for k, r in records.items() if not r.has_errors}
+
+        with tmp.open('wb') as f:
+            pickle.dump((_cache_version, records), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+        os.replace(tmp, self.path)
+
+
+def cache_file(root: Path, *variant: str) -> Union[Path, None]:
+    transient = os.environ.get('ZSHCOM__transient')
+
+    if not transient:
+        return None
+
+    digest = hashlib.sha1('\0'.join([root.as_posix(), *variant]).encode('utf-8')).hexdigest()[:16]
+
+    return Path(transient).resolve() / f'{_cache_file_prefix}{digest}'
+
+
+def load_cache(path: Path, refresh: bool = False) -> ScanCache:
+    entries: Dict[str, DirRecord] = {}
+
+    if not refresh and path.exists():
+        # noinspection PyBroadException
+        try:
+            with path.open('rb') as f:
+                (version, records) = pickle.load(f)
+
+            if version == _cache_version:
+                entries = records
+        except:
+            # A corrupt or foreign cache is just a cold cache
+            pass
+
+    return ScanCache(path, entries)
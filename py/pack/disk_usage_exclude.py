@@ -0,0 +1,163 @@
+import os
+import re
+from pathlib import Path
+from typing import List, Dict, Tuple, Union, Iterable
+
+_glob_chars = re.compile(r'[*?\[]')
+_regex_prefix = 're:'
+# Flags at the start of a user regex, they would land mid pattern once the rules are joined
+_leading_flags = re.compile(r'\(\?([aiLmsux]+)\)')
+_hidden_rule = '--exclude-hidden'
+
+
+def glob_to_regex(glob: str) -> str:
+    """Like fnmatch.translate but * and ? stop at /, ** crosses directories"""
+    res: List[str] = []
+    i = 0
+
+    while i < len(glob):
+        c = glob[i]
+
+        if c == '*':
+            if glob.startswith('**', i):
+                res.append('.*')
+                i += 1
+            else:
+                res.append('[^/]*')
+        elif c == '?':
+            res.append('[^/]')
+        elif c == '[':
+            end = glob.find(']', i + 2 if glob.startswith('[!', i) else i + 1)
+
+            if end == -1:
+                res.append(re.escape(c))
+            else:
+                body = glob[i + 1:end].replace('\\', r'\\')
+
+                if body.startswith('!'):
+                    body = '^' + body[1:]
+                elif body.startswith('^'):
+                    body = '\\' + body
+
+                res.append(f'[{body}]')
+                i = end
+        else:
+            res.append(re.escape(c))
+
+        i += 1
+
+    return ''.join(res)
+
+
+class ExcludeMatcher:
+    """
+    Exclusion rules compiled once and matched against directories the walk has already stat'ed.
+
+    Literal paths are stat'ed up front and matched by (st_dev, st_ino), so no directory is ever resolved during the
+    walk. Names, globs and regexes are folded into one regex with a named group per rule, the group that matched
+    says which rule to credit the hit to. User regexes with groups of their own would clash with those, they are
+    matched one by one after it.
+    """
+    _inodes: Dict[Tuple[int, int], str]
+    _regex: Union[re.Pattern, None]
+    _group_rules: Dict[str, str]
+    _grouped: List[Tuple[re.Pattern, str]]
+    rules: List[str]
+    missing: List[str]
+    # (rule, error) of the regexes that don't compile, skipped like missing paths
+    invalid: List[Tuple[str, str]]
+
+    def __init__(self, rules: Iterable[str], exclude_hidden: bool = False) -> None:
+        self._inodes = {}
+        self._group_rules = {}
+        self._grouped = []
+        self.rules = []
+        self.missing = []
+        self.invalid = []
+        patterns: List[str] = []
+
+        def add_pattern(rule: str, pattern: str) -> None:
+            group = f'r{len(self._group_rules)}'
+            self._group_rules[group] = rule
+            patterns.append(f'(?P<{group}>{pattern})')
+
+        if exclude_hidden:
+            self.rules.append(_hidden_rule)
+            add_pattern(_hidden_rule, r'.*/\.[^/]*')
+
+        for rule in rules:
+            rule = rule.strip()
+
+            if not rule or rule.startswith('#') or rule in self.rules:
+                continue
+
+            if rule.startswith(_regex_prefix):
+                body = rule[len(_regex_prefix):]
+                flags = _leading_flags.match(body)
+
+                if flags:
+                    # Scoped to the rule, (?i)x becomes (?i:x)
+                    body = f'(?{flags.group(1)}:{body[flags.end():]})'
+
+                # Compiled alone first, a bad rule is reported and skipped instead of breaking the joined regex
+                try:
+                    groups = re.compile(body).groups
+                except re.error as e:
+                    self.invalid.append((rule, str(e)))
+                    continue
+
+                # Searched anywhere in the absolute path, like re.search
+                pattern = f'.*?(?:{body}).*'
+
+                if groups:
+                    self._grouped.append((re.compile(pattern, re.DOTALL), rule))
+                else:
+                    add_pattern(rule, pattern)
+            elif _glob_chars.search(rule):
+                glob = os.path.expanduser(rule.rstrip('/'))
+                # Relative globs match the trailing part of the path, without a / they only see the folder name
+                add_pattern(rule, glob_to_regex(glob) if glob.startswith('/') else f'.*/{glob_to_regex(glob)}')
+            elif '/' not in rule and not rule.startswith('~'):
+                add_pattern(rule, f'.*/{re.escape(rule)}')
+            else:
+                try:
+                    st = os.stat(os.path.expanduser(rule))
+                except OSError:
+                    self.missing.append(rule)
+                    continue
+
+                self._inodes[(st.st_dev, st.st_ino)] = rule
+
+            self.rules.append(rule)
+
+        self._regex = re.compile('|'.join(patterns), re.DOTALL) if patterns else None
+
+    def __bool__(self) -> bool:
+        return bool(self.rules)
+
+    def match(self, path: str, st: os.stat_result) -> Union[str, None]:
+        """Returns the rule excluding the directory at path, st is its lstat from the walk"""
+        rule = self._inodes.get((st.st_dev, st.st_ino))
+
+        if rule is not None:
+            return rule
+
+        if self._regex is not None:
+            m = self._regex.fullmatch(path)
+
+            if m is not None:
+                return self._group_rules[m.lastgroup]
+
+        for (regex, rule) in self._grouped:
+            if regex.fullmatch(path):
+                return rule
+
+        return None
+
+
+def read_exclude_file(path: Path) -> List[str]:
+    if not path.exists():
+        return []
+
+    with path.open() as f:
+        return [line.strip() for line in f.readlines() if line.strip()]
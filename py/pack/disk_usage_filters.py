@@ -0,0 +1,53 @@
+import fnmatch
+import re
+from typing import Union
+
+
+class ScanFilter:
+    """
+    File and folder filters of a scan, compiled once and checked on names the listing already returned.
+
+    Name checks run before path checks and everything runs before a stat, so a filtered out file costs a regex match.
+    Folders that don't pass are pruned, nothing below them is listed. Matching returns the option that filtered the
+    entry out so the caller can count it, like ExcludeMatcher does with its rules.
+    """
+    _glob: Union[re.Pattern, None]
+    file_filter: Union[re.Pattern, None]
+    directory_filter: Union[re.Pattern, None]
+    path_filter: Union[re.Pattern, None]
+
+    def __init__(self, glob: Union[str, None] = None, file_filter: Union[re.Pattern, None] = None,
+                 directory_filter: Union[re.Pattern, None] = None, path_filter: Union[re.Pattern, None] = None) -> None:
+        self._glob = None if not glob or glob == '*' else re.compile(fnmatch.translate(glob))
+        self.file_filter = file_filter
+        self.directory_filter = directory_filter
+        self.path_filter = path_filter
+
+    def __bool__(self) -> bool:
+        return any(f is not None for f in (self._glob, self.file_filter, self.directory_filter, self.path_filter))
+
+    def match_file(self, name: str, path: str) -> Union[str, None]:
+        """Returns the option filtering the file out, the file filter wins over the path filter, only one of them is checked"""
+        if self._glob is not None and not self._glob.match(name):
+            return '--glob'
+
+        if self.file_filter is not None:
+            return None if self.file_filter.match(name) else '--file-filter'
+
+        if self.path_filter is not None:
+            return None if self.path_filter.match(path) else '--path-filter'
+
+        return None
+
+    def match_dir(self, name: str, path: str, top: bool = False) -> Union[str, None]:
+        """Returns the option pruning the folder. Like rglob, the glob only picks folders at the top, below it only file names have to match"""
+        if top and self._glob is not None and not self._glob.match(name):
+            return '--glob'
+
+        if self.directory_filter is not None:
+            return None if self.directory_filter.match(name) else '--directory-filter'
+
+        if self.path_filter is not None:
+            return None if self.path_filter.match(path) else '--path-filter'
+
+        return None
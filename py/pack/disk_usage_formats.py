@@ -0,0 +1,181 @@
+import json
+import sys
+from datetime import timedelta, datetime
+from pathlib import Path
+from typing import Dict, Callable, Any, List, TextIO, Union
+
+from disk_usage_models import Stat, State
+from disk_usage_snapshot import DiffRow
+
+Fields = Dict[str, Callable[[Stat], Any]]
+
+# Row key for the folder name, the rest of the keys come straight from the _fields map
+_folder_key = 'folder'
+
+
+def stat_row(d: Stat, fields: Fields) -> Dict[str, Any]:
+    row: Dict[str, Any] = {_folder_key: d.name}
+
+    for (k, f) in fields.items():
+        row[k] = f(d)
+
+    row['errors'] = d.has_errors
+
+    return row
+
+
+def timing(state: State, stopwatch: timedelta, cache_used: bool) -> Dict[str, Any]:
+    seconds = max(stopwatch.total_seconds(), 1e-9)
+    res: Dict[str, Any] = {
+        'seek_time': stopwatch.total_seconds(),
+        'syscalls': state.counters.syscalls,
+        'syscalls_per_file': round(state.counters.syscalls_per_file, 4),
+        'files_per_sec': round(state.counters.files / seconds),
+        'syscalls_per_sec': round(state.counters.syscalls / seconds)
+    }
+
+    if cache_used:
+        res['cache_hit_rate'] = round(state.counters.cache_hit_rate, 4)
+
+    if state.counters.ipc_bytes:
+        res['ipc_bytes'] = state.counters.ipc_bytes
+
+    if state.counters.throttle_wait_ns:
+        res['throttle_wait'] = state.counters.throttle_wait_ns / 1e9
+
+    return res
+
+
+def file_rows(state: State) -> Dict[str, List[Dict[str, Any]]]:
+    """--top-files and --newest, largest first and newest first"""
+    res: Dict[str, List[Dict[str, Any]]] = {}
+
+    if state.largest_files:
+        res['largest_files'] = [{'path': state.get_relative_path(Path(p)), 'size': size} for (size, p) in sorted(state.largest_files, reverse=True)]
+
+    if state.newest_files:
+        res['newest_files'] = [{'path': state.get_relative_path(Path(p)), 'mtime': datetime.fromtimestamp(mtime_ns / 1e9).isoformat()}
+                               for (mtime_ns, p) in sorted(state.newest_files, reverse=True)]
+
+    return res
+
+
+def ext_rows(state: State, fields: Fields) -> List[Dict[str, Any]]:
+    """--by-ext, largest first with the extension under the folder key"""
+    return [stat_row(e, fields) for e in sorted(state.ext_stats.values(), key=lambda e: e.size, reverse=True)]
+
+
+def print_json(state: State, sorted_dirs: List[Stat], stopwatch: timedelta, fields: Fields, timed: bool, cache_used: bool) -> None:
+    doc: Dict[str, Any] = {
+        'root': state.root.as_posix(),
+        'dirs': [stat_row(d, fields) for d in sorted_dirs],
+        'total': stat_row(state.total_stat, fields),
+        **({'extensions': ext_rows(state, fields)} if state.ext_stats else {}),
+        **file_rows(state),
+        **({'filtered': state.filter_hits} if state.filter_hits else {}),
+        'errors': state.get_errors(),
+        'error_counts': state.error_counts
+    }
+
+    if timed:
+        doc['timing'] = timing(state, stopwatch, cache_used)
+
+    json.dump(doc, sys.stdout, indent=2)
+    print('')
+
+
+def print_tsv(state: State, sorted_dirs: List[Stat], stopwatch: timedelta, fields: Fields, timed: bool, cache_used: bool) -> None:
+    keys = [_folder_key] + list(fields.keys())
+
+    def write_row(out: TextIO, cells: List[Any]) -> None:
+        # Tabs and newlines can't be escaped in TSV, they would split the row
+        out.write('\t'.join([str(c).replace('\t', ' ').replace('\n', ' ') for c in cells]) + '\n')
+
+    write_row(sys.stdout, keys)
+
+    for d in sorted_dirs + [state.total_stat]:
+        row = stat_row(d, fields)
+        write_row(sys.stdout, [row[k] for k in keys])
+
+    # stdout stays a single table, everything else goes to stderr
+    for row in ext_rows(state, fields):
+        write_row(sys.stderr, ['ext'] + [row[k] for k in keys])
+
+    for (k, files) in file_rows(state).items():
+        for f in files:
+            write_row(sys.stderr, [k, *f.values()])
+
+    for (option, hits) in state.filter_hits.items():
+        write_row(sys.stderr, ['filtered', option, hits])
+
+    errors = state.get_errors()
+
+    for k in errors:
+        for path in errors[k]:
+            write_row(sys.stderr, ['error', k, path])
+
+        write_row(sys.stderr, ['error_count', k, state.error_counts[k]])
+
+    if timed:
+        for (k, v) in timing(state, stopwatch, cache_used).items():
+            write_row(sys.stderr, ['timing', k, v])
+
+
+def diff_doc(root: str, snapshot_root: str, total: Union[DiffRow, None], rows: List[DiffRow]) -> Dict[str, Any]:
+    return {
+        'root': root,
+        'snapshot_root': snapshot_root,
+        'dirs': [r._asdict() for r in rows],
+        'total': total._asdict() if total else None
+    }
+
+
+def print_diff_json(root: str, snapshot_root: str, total: Union[DiffRow, None], rows: List[DiffRow]) -> None:
+    json.dump(diff_doc(root, snapshot_root, total, rows), sys.stdout, indent=2)
+    print('')
+
+
+def print_diff_tsv(total: Union[DiffRow, None], rows: List[DiffRow]) -> None:
+    sys.stdout.write('\t'.join(DiffRow._fields) + '\n')
+
+    for r in rows + ([total] if total else []):
+        sys.stdout.write('\t'.join([str(c).replace('\t', ' ').replace('\n', ' ') for c in r]) + '\n')
+
+
+class NdjsonWriter:
+    """One JSON object per line, dir rows are written as soon as their top level folder completes"""
+    _fields: Fields
+
+    def __init__(self, fields: Fields) -> None:
+        self._fields = fields
+
+    def write(self, kind: str, obj: Dict[str, Any]) -> None:
+        sys.stdout.write(json.dumps({'type': kind, **obj}) + '\n')
+        sys.stdout.flush()
+
+    def row(self, d: Stat) -> None:
+        self.write('dir', stat_row(d, self._fields))
+
+    def finish(self, state: State, stopwatch: timedelta, timed: bool, cache_used: bool) -> None:
+        self.write('total', stat_row(state.total_stat, self._fields))
+
+        for row in ext_rows(state, self._fields):
+            self.write('ext', row)
+
+        for (k, files) in file_rows(state).items():
+            for f in files:
+                self.write(k[:-1], f)
+
+        for (option, hits) in state.filter_hits.items():
+            self.write('filtered', {'option': option, 'count': hits})
+
+        errors = state.get_errors()
+
+        for k in errors:
+            for path in errors[k]:
+                self.write('error', {'key': k, 'path': path})
+
+            self.write('error_count', {'key': k, 'count': state.error_counts[k]})
+
+        if timed:
+            self.write('timing', timing(state, stopwatch, cache_used))
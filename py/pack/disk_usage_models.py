@@ -1,8 +1,62 @@
+import heapq
+import threading
 from pathlib import Path
-from typing import List, Iterator, Dict, Self, Union, Callable
+from typing import List, Iterator, Dict, Self, Union, Callable, NamedTuple, Tuple, TextIO
 
 from utils import ShellColors, is_in
 
+# Bucket 0 holds empty files, bucket n holds sizes in [2^(n-1), 2^n) and the last bucket everything from 128TiB up
+histogram_buckets = 48
+# Each sparkline cell spans 3 buckets (8x in size), the last cell takes everything from 4GiB up
+_spark_bucket_span = 3
+_spark_cells = 12
+_spark_levels = ' ▁▂▃▄▅▆▇█'
+# Paths kept per error key, past this errors are only counted and written to --error-log
+error_sample_limit = 10
+# Open --error-log files of this process, every task state writing to the same log shares one
+_error_logs: Dict[Path, TextIO] = {}
+_error_log_lock = threading.Lock()
+
+
+def size_bucket(size: int) -> int:
+    return min(size.bit_length(), histogram_buckets - 1)
+
+
+def histogram_percentile(histogram: List[int], p: float, max_size: int) -> int:
+    """Interpolated log-linearly inside the bucket the rank falls in, capped at the largest file actually seen"""
+    count = sum(histogram)
+
+    if count == 0:
+        return 0
+
+    rank = max(p / 100 * count, 1)
+    seen = 0
+
+    for (i, c) in enumerate(histogram):
+        if c and seen + c >= rank:
+            if i == 0:
+                return 0
+
+            lo = 1 << (i - 1)
+            # Files are assumed spread evenly on a log scale, each one sitting in the middle of its share of the bucket
+            return min(round(lo * 2 ** ((rank - seen - 0.5) / c)), max_size)
+
+        seen += c
+
+    return max_size
+
+
+def histogram_sparkline(histogram: List[int]) -> str:
+    cells = [sum(histogram[i * _spark_bucket_span:(i + 1) * _spark_bucket_span]) for i in range(_spark_cells - 1)]
+    cells.append(sum(histogram[(_spark_cells - 1) * _spark_bucket_span:]))
+    top = max(cells)
+
+    if top == 0:
+        return ' ' * _spark_cells
+
+    # Anything non-empty gets at least the lowest bar so a single huge file still shows up
+    return ''.join([_spark_levels[0] if c == 0 else _spark_levels[max(1, round(c / top * (len(_spark_levels) - 1)))] for c in cells])
+
 
 class Stat:
     name: str
@@ -39,6 +93,8 @@ class BareStat(Stat):
     _size: int
     _file_count: int
     _max_size: int
+    # File counts per log2 size bucket, see size_bucket
+    histogram: List[int]
 
     def __init__(self, name: str):
         super().__init__(name)
@@ -46,6 +102,7 @@ class BareStat(Stat):
         self._file_count = 0
         self._max_size = 0
         self._has_errors = False
+        self.histogram = [0] * histogram_buckets
 
     @property
     def has_errors(self) -> bool:
@@ -70,120 +127,329 @@ class BareStat(Stat):
     def max_size(self) -> int:
         return self._max_size
 
+    def percentile(self, p: float) -> int:
+        return histogram_percentile(self.histogram, p, self._max_size)
 
-class Dir(Stat):
-    _density: Union[int, None] = None
-    _has_errors: bool
-    name: str
-    sizes: List[int]
+    @property
+    def sparkline(self) -> str:
+        return histogram_sparkline(self.histogram)
 
-    def __init__(self, name: str):
-        super().__init__(name)
-        self.name = name
-        self.sizes = []
-        self._has_errors = False
+    def add_file(self, size: int) -> None:
+        self._size += size
+        self._file_count += 1
+        self.histogram[size_bucket(size)] += 1
 
-    @property
-    def size(self) -> int:
-        return sum(self.sizes)
+        if size > self._max_size:
+            self._max_size = size
+
+    def remove_file(self, size: int) -> None:
+        # The max can't be walked back without the other sizes, it stays as an upper bound
+        self._size -= size
+        self._file_count -= 1
+        self.histogram[size_bucket(size)] -= 1
+
+    def add_size(self, size: int) -> None:
+        """Space that isn't a file, like the blocks a directory takes up itself"""
+        self._size += size
+
+    # noinspection PyProtectedMember
+    def merge(self, stat: Self) -> None:
+        self._size += stat.size
+        self._file_count += stat.file_count
+
+        if stat.max_size > self._max_size:
+            self._max_size = stat.max_size
+
+        for i, c in enumerate(stat.histogram):
+            self.histogram[i] += c
+
+
+class Dir(BareStat):
+
+    def had_error(self, he: bool) -> None:
+        self._has_errors = self._has_errors or he
+
+    def merge(self, d: Self) -> None:
+        super().merge(d)
+        self.had_error(d.has_errors)
+
+
+class DirRecord(NamedTuple):
+    """Aggregates for the files directly inside one directory, plus what is needed to trust and re-walk it later"""
+    ino: int
+    mtime_ns: int
+    file_count: int
+    size: int
+    max_size: int
+    # Only the non-empty (bucket, count) pairs
+    histogram: Tuple[Tuple[int, int], ...]
+    sub_dirs: Tuple[str, ...]
+    has_errors: bool
+
+    @staticmethod
+    def from_stat(ino: int, mtime_ns: int, stat: BareStat, sub_dirs: List[str], has_errors: bool) -> 'DirRecord':
+        return DirRecord(ino, mtime_ns, stat.file_count, stat.size, stat.max_size,
+                         tuple((i, c) for i, c in enumerate(stat.histogram) if c), tuple(sub_dirs), has_errors)
+
+    # noinspection PyProtectedMember
+    def to_stat(self, name: str) -> Dir:
+        d = Dir(name)
+        d._file_count = self.file_count
+        d._size = self.size
+        d._max_size = self.max_size
+
+        for (i, c) in self.histogram:
+            d.histogram[i] = c
+
+        d.had_error(self.has_errors)
+
+        return d
+
+    def without_file(self, size: int) -> 'DirRecord':
+        stat = self.to_stat('')
+        stat.remove_file(size)
+
+        return DirRecord.from_stat(self.ino, self.mtime_ns, stat, list(self.sub_dirs), self.has_errors)
+
+
+class ScanCounters:
+    listings: int
+    stats: int
+    files: int
+    cache_hits: int
+    cache_misses: int
+    ipc_bytes: int
+    # Summed over workers, time spent asleep in the --max-iops token bucket
+    throttle_wait_ns: int
+
+    def __init__(self) -> None:
+        self.listings = 0
+        self.stats = 0
+        self.files = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.ipc_bytes = 0
+        self.throttle_wait_ns = 0
 
     @property
-    def file_count(self):
-        return len(self.sizes)
+    def syscalls(self) -> int:
+        return self.listings + self.stats
 
     @property
-    def max_size(self) -> int:
-        return max(self.sizes) if self.sizes else 0
+    def syscalls_per_file(self) -> float:
+        return self.syscalls / self.files if self.files else 0.0
 
     @property
-    def has_errors(self) -> bool:
-        return self._has_errors
+    def cache_hit_rate(self) -> float:
+        looked_up = self.cache_hits + self.cache_misses
+        return self.cache_hits / looked_up if looked_up else 0.0
+
+    def merge(self, counters: Self) -> None:
+        self.listings += counters.listings
+        self.stats += counters.stats
+        self.files += counters.files
+        self.cache_hits += counters.cache_hits
+        self.cache_misses += counters.cache_misses
+        self.ipc_bytes += counters.ipc_bytes
+        self.throttle_wait_ns += counters.throttle_wait_ns
 
-    def had_error(self, he: bool) -> None:
-        self._has_errors = self._has_errors or he
+
+def log_error(log: Path, key: str, path: Path) -> None:
+    with _error_log_lock:
+        f = _error_logs.get(log)
+
+        if f is None:
+            # Line buffered, pool workers exit without flushing
+            f = _error_logs[log] = log.open('a', buffering=1, errors='surrogateescape')
+
+        f.write(f'{key}\t{path.as_posix()}\n')
 
 
 class State:
+    # Up to error_sample_limit paths per key, error_counts has how many there were
     _errors: Dict[str, List[Path]]
-    _dirs: List[Stat]
+    error_counts: Dict[str, int]
+    _error_log: Union[Path, None]
+    _dirs: List[BareStat]
+    _dir_index: Dict[str, BareStat]
     _root: Path
     name: str
     total_stat: BareStat
-    root_stat: BareStat
-
-    def __init__(self, root: Path, root_stat: BareStat, total_stat: BareStat) -> None:
+    root_stat: Dir
+    counters: ScanCounters
+    # Keyed by absolute path, only collected when the cache or --depth needs them
+    dir_records: Dict[str, DirRecord]
+    # (st_dev, st_ino) of hard linked files already counted, with the size, row and folder they were credited to
+    inodes: Dict[Tuple[int, int], Tuple[int, str, str]]
+    # Directories skipped per exclusion rule
+    exclusion_hits: Dict[str, int]
+    # Files and folders turned away per --glob and --*-filter option
+    filter_hits: Dict[str, int]
+    # Min heaps of (st_size, path) and (st_mtime_ns, path), never more than their limit long
+    largest_files: List[Tuple[int, str]]
+    newest_files: List[Tuple[int, str]]
+    _largest_limit: int
+    _newest_limit: int
+    # Files per lowercase suffix for --by-ext, '' for files without one
+    ext_stats: Dict[str, BareStat]
+
+    def __init__(self, root: Path, root_stat: Dir, total_stat: BareStat, largest_limit: int = 0, newest_limit: int = 0,
+                 error_log: Union[Path, None] = None) -> None:
         self._root = root
         self.name = root.name
         self._errors = {}
+        self.error_counts = {}
+        self._error_log = error_log
         self._dirs = []
+        self._dir_index = {}
         self.total_stat = total_stat
         self.root_stat = root_stat
+        self.counters = ScanCounters()
+        self.dir_records = {}
+        self.inodes = {}
+        self.exclusion_hits = {}
+        self.filter_hits = {}
+        self.largest_files = []
+        self.newest_files = []
+        self._largest_limit = largest_limit
+        self._newest_limit = newest_limit
+        self.ext_stats = {}
 
     def task_state(self, base: Path) -> Self:
-        return State(base, BareStat(self.root_stat.name), BareStat(self.total_stat.name))
+        return State(base, Dir(self.root_stat.name), BareStat(self.total_stat.name), self._largest_limit, self._newest_limit, self._error_log)
+
+    @property
+    def tracks_files(self) -> bool:
+        return bool(self._largest_limit or self._newest_limit)
+
+    @staticmethod
+    def _push_bounded(heap: List[Tuple[int, str]], item: Tuple[int, str], limit: int) -> None:
+        if len(heap) < limit:
+            heapq.heappush(heap, item)
+        elif limit and item > heap[0]:
+            heapq.heapreplace(heap, item)
+
+    def add_ext(self, ext: str, size: int) -> None:
+        es = self.ext_stats.get(ext)
+
+        if es is None:
+            es = self.ext_stats[ext] = BareStat(ext)
+
+        es.add_file(size)
+
+    def track_file(self, size: int, mtime_ns: int, path: str) -> None:
+        self._push_bounded(self.largest_files, (size, path), self._largest_limit)
+        self._push_bounded(self.newest_files, (mtime_ns, path), self._newest_limit)
 
     @property
-    def dirs(self) -> Iterator[Stat]:
+    def dirs(self) -> Iterator[BareStat]:
         return iter(self._dirs)
 
     @property
     def root(self) -> Path:
         return self._root
 
+    def get_dir(self, name: str) -> Union[BareStat, None]:
+        return self._dir_index.get(name)
+
     @property
     def has_errors(self) -> bool:
-        return bool(self._errors.keys())
-
-    # noinspection PyShadowingBuiltins, PyProtectedMember
-    def add_dir(self, dir: Stat) -> None:
-        self._dirs.append(dir)
+        return bool(self.error_counts)
 
-        self.total_stat._size += dir.size
-        self.total_stat._file_count += dir.file_count
-        dmx = dir.max_size
+    @property
+    def error_count(self) -> int:
+        return sum(self.error_counts.values())
 
-        if dmx > self.total_stat.max_size:
-            self.total_stat._max_size = dmx
+    # noinspection PyShadowingBuiltins, PyProtectedMember
+    def add_dir(self, dir: BareStat) -> None:
+        # Partial results for the same top level dir are credited to a single row
+        existing = self._dir_index.get(dir.name)
 
-    # noinspection PyProtectedMember
-    def add_to_root(self, size: int, has_errors: bool) -> None:
-        self.root_stat._size += size
-        self.root_stat._file_count += 1
-        self.root_stat._has_errors = self.root_stat.has_errors or has_errors
+        if existing is None:
+            self._dirs.append(dir)
+            self._dir_index[dir.name] = dir
+        else:
+            existing.merge(dir)
 
-        if size > self.root_stat.max_size:
-            self.root_stat._max_size = size
+        self.total_stat.merge(dir)
 
     def calculate(self) -> None:
         pass
 
     def error(self, key: str, path: Path) -> None:
-        if key not in self._errors:
-            self._errors[key] = []
+        self.add_errors(key, 1, [path])
 
-        self._errors[key].append(path)
+        # Written where the error happens, merges only ever move the counts and samples
+        if self._error_log is not None:
+            log_error(self._error_log, key, path)
+
+    def add_errors(self, key: str, count: int, samples: List[Path]) -> None:
+        self.error_counts[key] = self.error_counts.get(key, 0) + count
+        kept = self._errors.setdefault(key, [])
+        kept.extend(samples[:error_sample_limit - len(kept)])
+
+    def excluded(self, rule: str, path: Path) -> None:
+        self.error('Excluded', path)
+        self.exclusion_hits[rule] = self.exclusion_hits.get(rule, 0) + 1
+
+    def filtered(self, option: str) -> None:
+        # Not an error, the filters asked for it
+        self.filter_hits[option] = self.filter_hits.get(option, 0) + 1
 
     def get_relative_path(self, path: Path) -> str:
         return path.relative_to(self._root).as_posix() if path.is_relative_to(self._root) else path.as_posix()
 
     def get_errors(self) -> Dict[str, List[str]]:
+        """The sampled paths per key, error_counts has the totals"""
         return {k: [self.get_relative_path(p) for p in v] for k, v in self._errors.items()}
 
+    def unsampled_errors(self, key: str) -> int:
+        return self.error_counts.get(key, 0) - len(self._errors.get(key, []))
+
     # noinspection PyProtectedMember
     def merge(self, state: Self) -> None:
-        for k in state._errors.keys():
-            for path in state._errors[k]:
-                self.error(k, path)
+        self.counters.merge(state.counters)
+        self.dir_records.update(state.dir_records)
 
-        for d in state._dirs:
-            self.add_dir(d)
+        # Another task already counted these, take them back out of the incoming rows before they are added
+        for (inode, (size, row, path)) in state.inodes.items():
+            if inode in self.inodes:
+                (state.root_stat if row == state.root_stat.name else state.get_dir(row)).remove_file(size)
+                # The folder's record too, --depth and --browse roll their totals up from the records
+                rec = self.dir_records.get(path)
+
+                if rec is not None:
+                    self.dir_records[path] = rec.without_file(size)
+            else:
+                self.inodes[inode] = (size, row, path)
+
+        for (k, count) in state.error_counts.items():
+            self.add_errors(k, count, state._errors.get(k, []))
+
+        for (rule, hits) in state.exclusion_hits.items():
+            self.exclusion_hits[rule] = self.exclusion_hits.get(rule, 0) + hits
+
+        for (option, hits) in state.filter_hits.items():
+            self.filter_hits[option] = self.filter_hits.get(option, 0) + hits
+
+        for (ext, es) in state.ext_stats.items():
+            existing = self.ext_stats.get(ext)
 
-        self.root_stat._size += state.root_stat.size
+            if existing is None:
+                self.ext_stats[ext] = es
+            else:
+                existing.merge(es)
 
-        if state.root_stat.max_size > self.root_stat.max_size:
-            self.root_stat._max_size = state.root_stat.max_size
+        for item in state.largest_files:
+            self._push_bounded(self.largest_files, item, self._largest_limit)
 
-        self.root_stat._file_count += state.root_stat.file_count
+        for item in state.newest_files:
+            self._push_bounded(self.newest_files, item, self._newest_limit)
+
+        for d in state._dirs:
+            self.add_dir(d)
+
+        self.root_stat.merge(state.root_stat)
 
         if state.root_stat.max_size > self.total_stat.max_size:
             self.total_stat._max_size = state.root_stat.max_size
@@ -250,6 +516,9 @@ class Grid:
     def remove_last_field(self) -> None:
         _ = self._fields.pop()
 
+    def remove_field(self, name: str) -> None:
+        self._fields = [f for f in self._fields if f.name != name]
+
     def can_fit_field(self, field: Field, buffer: int = 0) -> bool:
         return self.remaining_width(buffer) > field.width + self.field_padding
 
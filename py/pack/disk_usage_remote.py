@@ -0,0 +1,241 @@
+import os
+import queue
+import re
+import shlex
+import struct
+import subprocess
+import sys
+import threading
+from pathlib import Path
+from typing import List, Tuple, Iterator, BinaryIO, Union, Dict, Callable, Set
+
+from disk_usage_models import Dir, BareStat, State, Stat, histogram_buckets
+
+# The agent speaks in frames: a type byte and a payload length, then the payload
+_frame = struct.Struct('<BI')
+_hello = struct.Struct('<H')
+# size, count, max, has errors, complete, then the name and the sparse histogram
+_row = struct.Struct('<qqq??H')
+_bucket = struct.Struct('<Bq')
+_buckets = struct.Struct('<B')
+# key length and how many errors there were, then the key and the sampled paths split by NULs
+_error = struct.Struct('<Hq')
+# files, listings, stats, seek seconds
+_done = struct.Struct('<qqqd')
+_protocol_version = 2
+
+FRAME_HELLO = 1
+FRAME_ROW = 2
+FRAME_ROOT = 3
+FRAME_ERROR = 4
+FRAME_DONE = 5
+
+_target_pattern = re.compile(r'^([A-Za-z0-9_.@-]+):(.+)$')
+# Runs the agent where a host:/path target asks, without a template the local stand-in is used
+local_host = 'local'
+default_remote_cmd = 'ssh {host} duh'
+
+
+class Target:
+    host: str
+    path: str
+    label: str
+
+    def __init__(self, host: str, path: str) -> None:
+        self.host = host
+        self.path = path
+        self.label = host
+
+
+def parse_target(spec: str) -> Union[Target, None]:
+    """host:/path, anything that exists locally or doesn't have a host part is not a target"""
+    m = _target_pattern.match(spec)
+
+    if m is None or Path(spec).exists():
+        return None
+
+    return Target(m.group(1), m.group(2))
+
+
+def label_targets(targets: List[Target]) -> None:
+    # Rows are named host:top, a host scanned at more than one path keeps the path in the label
+    hosts = [t.host for t in targets]
+
+    for t in targets:
+        t.label = t.host if hosts.count(t.host) == 1 else f'{t.host}:{t.path}'
+
+
+# region Agent
+
+def encode_stat(stat: BareStat, complete: bool = True) -> bytes:
+    name = stat.name.encode('utf-8', 'surrogateescape')
+    buckets = [(i, c) for (i, c) in enumerate(stat.histogram) if c]
+
+    return (_row.pack(stat.size, stat.file_count, stat.max_size, stat.has_errors, complete, len(name)) + name +
+            _buckets.pack(len(buckets)) + b''.join([_bucket.pack(i, c) for (i, c) in buckets]))
+
+
+# noinspection PyProtectedMember
+def decode_stat(payload: bytes, name_prefix: str = '') -> Tuple[Dir, bool]:
+    (size, count, max_size, has_errors, complete, name_len) = _row.unpack_from(payload)
+    offset = _row.size
+    d = Dir(name_prefix + payload[offset:offset + name_len].decode('utf-8', 'surrogateescape'))
+    offset += name_len
+    (bucket_count,) = _buckets.unpack_from(payload, offset)
+    offset += _buckets.size
+
+    for _ in range(bucket_count):
+        (i, c) = _bucket.unpack_from(payload, offset)
+        offset += _bucket.size
+
+        if i < histogram_buckets:
+            d.histogram[i] = c
+
+    d._size = size
+    d._file_count = count
+    d._max_size = max_size
+    d.had_error(has_errors)
+
+    return d, complete
+
+
+class AgentWriter:
+    """--serve side, frames go out as soon as each top level row completes"""
+    _out: BinaryIO
+    _lock: threading.Lock
+
+    def __init__(self, out: BinaryIO, root: Path) -> None:
+        self._out = out
+        self._lock = threading.Lock()
+        self.write(FRAME_HELLO, _hello.pack(_protocol_version) + root.as_posix().encode('utf-8', 'surrogateescape'))
+
+    def write(self, frame_type: int, payload: bytes) -> None:
+        with self._lock:
+            self._out.write(_frame.pack(frame_type, len(payload)) + payload)
+            self._out.flush()
+
+    def row(self, row: Stat, complete: bool) -> None:
+        if complete:
+            self.write(FRAME_ROW, encode_stat(row))
+
+    def finish(self, state: State, seconds: float) -> None:
+        self.write(FRAME_ROOT, encode_stat(state.root_stat))
+        errors = state.get_errors()
+
+        for k in errors:
+            key = k.encode('utf-8')
+            paths = b'\0'.join([p.encode('utf-8', 'surrogateescape') for p in errors[k]])
+            self.write(FRAME_ERROR, _error.pack(len(key), state.error_counts[k]) + key + paths)
+
+        self.write(FRAME_DONE, _done.pack(state.counters.files, state.counters.listings, state.counters.stats, seconds))
+
+
+def claim_stdout() -> BinaryIO:
+    """The frames get the real stdout, fd 1 is pointed at stderr so logs and traces, the pool's included, can't corrupt them"""
+    sys.stdout.flush()
+    out = os.fdopen(os.dup(1), 'wb')
+    os.dup2(2, 1)
+
+    return out
+
+# endregion
+
+
+# region Client
+
+def read_frames(stream: BinaryIO) -> Iterator[Tuple[int, bytes]]:
+    while True:
+        head = stream.read(_frame.size)
+
+        if len(head) < _frame.size:
+            return
+
+        (frame_type, length) = _frame.unpack(head)
+        payload = stream.read(length)
+
+        if len(payload) < length:
+            return
+
+        yield frame_type, payload
+
+
+def agent_command(target: Target, remote_cmd: Union[str, None], agent_args: List[str]) -> List[str]:
+    args = ['--serve', target.path] + agent_args
+
+    if target.host == local_host and remote_cmd is None:
+        return [sys.executable, os.path.abspath(os.path.join(os.path.dirname(__file__), 'disk_usage.py'))] + args
+
+    # ssh joins its arguments into one remote shell command, so they are quoted for that shell
+    return shlex.split((remote_cmd or default_remote_cmd).format(host=shlex.quote(target.host))) + [shlex.quote(a) for a in args]
+
+
+def _read_agent(target: Target, cmd: List[str], results: queue.SimpleQueue) -> None:
+    # noinspection PyBroadException
+    try:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stdin=subprocess.DEVNULL)
+
+        for (frame_type, payload) in read_frames(proc.stdout):
+            results.put((target, frame_type, payload))
+
+        results.put((target, None, proc.wait()))
+    except Exception as e:
+        results.put((target, None, e))
+
+
+def collect_remote(state: State, targets: List[Target], remote_cmd: Union[str, None], agent_args: List[str],
+                   on_row: Union[Callable[[Stat, bool], None], None] = None) -> None:
+    """Runs an agent per target at once and merges their rows into state as they arrive, named label:top"""
+    results: queue.SimpleQueue = queue.SimpleQueue()
+    running = len(targets)
+    done: Dict[Target, bool] = {}
+    # Agents speaking another protocol, their frames can't be decoded and are dropped
+    mismatched: Set[Target] = set()
+
+    for t in targets:
+        threading.Thread(target=_read_agent, args=(t, agent_command(t, remote_cmd, agent_args), results), daemon=True).start()
+
+    while running > 0:
+        (target, frame_type, payload) = results.get()
+        prefix = f'{target.label}:'
+
+        if frame_type is None:
+            running -= 1
+
+            if isinstance(payload, Exception):
+                state.error(f'Unable to run agent: {payload}', Path(prefix))
+            elif target not in mismatched and (payload != 0 or not done.get(target)):
+                state.error(f'Agent exited with {payload}', Path(prefix))
+        elif target in mismatched:
+            continue
+        elif frame_type == FRAME_HELLO:
+            (version,) = _hello.unpack_from(payload)
+
+            if version != _protocol_version:
+                state.error(f'Agent speaks protocol {version}, expected {_protocol_version}', Path(prefix))
+                mismatched.add(target)
+        elif frame_type in (FRAME_ROW, FRAME_ROOT):
+            (d, complete) = decode_stat(payload, prefix)
+
+            if frame_type == FRAME_ROOT:
+                d.name = f'{prefix}./'
+
+                if d.file_count == 0 and d.size == 0:
+                    continue
+
+            state.add_dir(d)
+
+            if on_row:
+                on_row(state.get_dir(d.name), complete)
+        elif frame_type == FRAME_ERROR:
+            (key_len, count) = _error.unpack_from(payload)
+            key = payload[_error.size:_error.size + key_len].decode('utf-8')
+            paths = payload[_error.size + key_len:]
+            state.add_errors(key, count, [Path(prefix + p.decode('utf-8', 'surrogateescape')) for p in paths.split(b'\0')] if paths else [])
+        elif frame_type == FRAME_DONE:
+            (files, listings, stats, _) = _done.unpack(payload)
+            state.counters.files += files
+            state.counters.listings += listings
+            state.counters.stats += stats
+            done[target] = True
+
+# endregion
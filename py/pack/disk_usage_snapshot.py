@@ -0,0 +1,139 @@
+import heapq
+import os
+import struct
+from pathlib import Path
+from typing import List, Dict, Iterator, NamedTuple, Tuple, BinaryIO, Union
+
+from disk_usage_models import DirRecord
+from disk_usage_tree import CompactTree
+
+_magic = b'DUHSNAP'
+_version = 1
+_header = struct.Struct('<7sBI')
+# path length, st_ino, st_mtime_ns, size, count, max, has errors, followed by the path itself
+_record = struct.Struct('<Iqqqqq?')
+_write_buffer = 1 << 20
+
+
+class SnapshotRow(NamedTuple):
+    """Subtree totals of one directory, path is relative to the scanned root and '.' for the root itself"""
+    path: bytes
+    ino: int
+    mtime_ns: int
+    size: int
+    count: int
+    max_size: int
+    has_errors: bool
+
+
+class DiffRow(NamedTuple):
+    path: str
+    size: int
+    size_delta: int
+    count: int
+    count_delta: int
+    # new, gone, replaced (same path, different inode) or changed
+    status: str
+
+
+def snapshot_rows(tree: CompactTree, records: Dict[str, DirRecord], root_ino: int, root_mtime_ns: int) -> List[SnapshotRow]:
+    """Every node of the tree sorted by path bytes, the order both sides of a diff are merged in"""
+    root = tree.names[0]
+    rel: List[bytes] = [b'.']
+    rows: List[SnapshotRow] = [SnapshotRow(b'.', root_ino, root_mtime_ns, tree.size[0], tree.count[0], tree.max[0], bool(tree.errors[0]))]
+
+    # Parents always have the lower index, their path is ready before any child needs it
+    for i in range(1, len(tree)):
+        p = tree.parent[i]
+        name = os.fsencode(tree.names[i])
+        path = name if p == 0 else rel[p] + b'/' + name
+        rel.append(path)
+        rec = records.get(f'{root}/{os.fsdecode(path)}')
+        rows.append(SnapshotRow(path, rec.ino if rec else 0, rec.mtime_ns if rec else 0, tree.size[i], tree.count[i], tree.max[i], bool(tree.errors[i])))
+
+    rows.sort(key=lambda r: r.path)
+
+    return rows
+
+
+def write_snapshot(path: Path, root: str, rows: List[SnapshotRow]) -> None:
+    tmp = path.with_name(f'{path.name}.tmp')
+    root_bytes = os.fsencode(root)
+
+    with tmp.open('wb', buffering=_write_buffer) as f:
+        f.write(_header.pack(_magic, _version, len(root_bytes)) + root_bytes)
+
+        for r in rows:
+            f.write(_record.pack(len(r.path), r.ino, r.mtime_ns, r.size, r.count, r.max_size, r.has_errors) + r.path)
+
+    os.replace(tmp, path)
+
+
+def read_header(f: BinaryIO) -> str:
+    (magic, version, root_len) = _header.unpack(f.read(_header.size))
+
+    if magic != _magic or version != _version:
+        raise ValueError('not a duh snapshot or from an incompatible version')
+
+    return os.fsdecode(f.read(root_len))
+
+
+def iter_snapshot(f: BinaryIO) -> Iterator[SnapshotRow]:
+    """Streams the rows after the header, in the sorted order they were written"""
+    while True:
+        head = f.read(_record.size)
+
+        if not head:
+            return
+
+        (path_len, *values) = _record.unpack(head)
+        yield SnapshotRow(f.read(path_len), *values)
+
+
+def diff_rows(old: Iterator[SnapshotRow], new: Iterator[SnapshotRow], max_depth: int) -> Iterator[DiffRow]:
+    """Merges two sorted row streams, only one row from each side is held at a time"""
+    o = next(old, None)
+    n = next(new, None)
+
+    while o is not None or n is not None:
+        if n is None or (o is not None and o.path < n.path):
+            (path, row) = (o.path, DiffRow(os.fsdecode(o.path), 0, -o.size, 0, -o.count, 'gone'))
+            o = next(old, None)
+        elif o is None or n.path < o.path:
+            (path, row) = (n.path, DiffRow(os.fsdecode(n.path), n.size, n.size, n.count, n.count, 'new'))
+            n = next(new, None)
+        else:
+            status = 'replaced' if o.ino and n.ino and o.ino != n.ino else 'changed'
+            (path, row) = (n.path, DiffRow(os.fsdecode(n.path), n.size, n.size - o.size, n.count, n.count - o.count, status))
+            o = next(old, None)
+            n = next(new, None)
+
+        if (row.size_delta or row.count_delta) and (path == b'.' or path.count(b'/') < max_depth):
+            yield row
+
+
+def top_growth(rows: Iterator[DiffRow], limit: int, shrink: bool = False) -> List[DiffRow]:
+    # nlargest keeps a heap of limit rows, the rest of the stream is never held
+    key = (lambda r: -r.size_delta) if shrink else (lambda r: r.size_delta)
+
+    return heapq.nlargest(limit, rows, key=key)
+
+
+def diff_snapshot(snapshot: Path, new_rows: List[SnapshotRow], max_depth: int, limit: int, shrink: bool = False) -> Tuple[str, Union[DiffRow, None], List[DiffRow]]:
+    """Returns the root the snapshot was taken of, the root row and the directories that grew the most"""
+    total: Union[DiffRow, None] = None
+
+    def without_root(rows: Iterator[DiffRow]) -> Iterator[DiffRow]:
+        nonlocal total
+
+        for r in rows:
+            if r.path == '.':
+                total = r
+            else:
+                yield r
+
+    with snapshot.open('rb', buffering=_write_buffer) as f:
+        old_root = read_header(f)
+        top = top_growth(without_root(diff_rows(iter_snapshot(f), iter(new_rows), max_depth)), limit, shrink)
+
+    return old_root, total, top
@@ -0,0 +1,70 @@
+import multiprocessing as mp
+import os
+import time
+from typing import Union
+
+from logger import Logger
+
+# Niceness added by --nice, the IO class drops to idle alongside it
+_nice_increment = 10
+
+
+class TokenBucket:
+    """
+    Rate limit shared by every pool worker, one token per listing or stat.
+
+    Taking more tokens than are left puts the bucket in debt and the caller sleeps it off, so a huge directory is
+    charged up front instead of being split into many small waits.
+    """
+    _rate: float
+    _burst: float
+    _tokens: mp.Value
+    _stamp: mp.Value
+    _lock: mp.Lock
+
+    def __init__(self, rate: float, burst: Union[float, None] = None) -> None:
+        self._rate = rate
+        self._burst = burst or rate
+        self._tokens = mp.Value('d', self._burst, lock=False)
+        self._stamp = mp.Value('d', time.monotonic(), lock=False)
+        self._lock = mp.Lock()
+
+    @property
+    def rate(self) -> float:
+        return self._rate
+
+    def take(self, n: int) -> int:
+        """Returns the nanoseconds spent waiting"""
+        if n <= 0:
+            return 0
+
+        with self._lock:
+            now = time.monotonic()
+            tokens = min(self._burst, self._tokens.value + (now - self._stamp.value) * self._rate) - n
+            self._tokens.value = tokens
+            self._stamp.value = now
+
+        if tokens >= 0:
+            return 0
+
+        wait = -tokens / self._rate
+        time.sleep(wait)
+
+        return int(wait * 1e9)
+
+
+def lower_priority(log: Logger) -> None:
+    """Drops the CPU and IO priority of this process, pool workers started afterwards inherit both"""
+    os.nice(_nice_increment)
+
+    try:
+        import psutil
+    except ImportError:
+        log.trace('psutil not installed, IO priority left as is')
+        return
+
+    try:
+        psutil.Process().ionice(psutil.IOPRIO_CLASS_IDLE)
+    except (AttributeError, OSError, psutil.Error) as e:
+        # ionice only exists on Linux and Windows
+        log.trace(f'Unable to lower IO priority: {e}')
@@ -0,0 +1,246 @@
+from array import array
+from collections import deque
+from typing import List, Dict, Callable, Any, Iterator, Tuple, Deque
+
+from disk_usage_models import Dir, DirRecord, Stat, BareStat
+
+
+class TreeNode:
+    name: str
+    path: str
+    depth: int
+    stat: Dir
+    children: List['TreeNode']
+
+    def __init__(self, name: str, path: str, depth: int) -> None:
+        self.name = name
+        self.path = path
+        self.depth = depth
+        self.stat = Dir(name)
+        self.children = []
+
+
+def build_tree(name: str, path: str, depth: int, records: Dict[str, DirRecord], max_depth: int) -> TreeNode:
+    """Rolls the per directory records under path up into subtree totals, nodes deeper than max_depth are folded into their parent"""
+    root = TreeNode(name, path, depth)
+    # Iterative post order walk, trees deeper than the recursion limit are not unusual on NAS shares
+    stack: List[Tuple[TreeNode, bool]] = [(root, False)]
+
+    while stack:
+        (node, rolled_up) = stack.pop()
+        rec = records.get(node.path)
+
+        if not rolled_up:
+            stack.append((node, True))
+
+            if rec is not None:
+                for sub in rec.sub_dirs:
+                    sub_path = f'{node.path}/{sub}'
+
+                    # Excluded dirs and mounts were never walked so they have no record
+                    if sub_path in records:
+                        child = TreeNode(sub, sub_path, node.depth + 1)
+                        node.children.append(child)
+                        stack.append((child, False))
+        else:
+            if rec is not None:
+                node.stat = rec.to_stat(node.name)
+
+            for child in node.children:
+                node.stat.merge(child.stat)
+
+            if node.depth >= max_depth:
+                node.children = []
+
+    return root
+
+
+def iter_tree(nodes: List[TreeNode], sorter: Callable[[Stat], Any], reverse: bool, top_k: int) -> Iterator[TreeNode]:
+    """Pre order, each node followed by its top_k children"""
+    stack: List[TreeNode] = list(reversed(sorted(nodes, key=lambda n: sorter(n.stat), reverse=reverse)[:top_k]))
+
+    while stack:
+        node = stack.pop()
+        yield node
+
+        if node.children:
+            stack += reversed(sorted(node.children, key=lambda n: sorter(n.stat), reverse=reverse)[:top_k])
+
+
+class CompactTree:
+    """The whole scanned tree in flat arrays, indexes are assigned breadth first so each node's children are contiguous
+
+    Subtree totals live in size/count/max, the own_* arrays hold the files directly inside each directory
+    """
+    names: List[str]
+    parent: array
+    child_start: array
+    child_count: array
+    own_size: array
+    own_count: array
+    own_max: array
+    own_errors: array
+    size: array
+    count: array
+    max: array
+    errors: array
+
+    def __init__(self) -> None:
+        self.names = []
+        self.parent = array('q')
+        self.child_start = array('q')
+        self.child_count = array('q')
+        self.own_size = array('q')
+        self.own_count = array('q')
+        self.own_max = array('q')
+        self.own_errors = array('b')
+        self.size = array('q')
+        self.count = array('q')
+        self.max = array('q')
+        self.errors = array('b')
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    @staticmethod
+    def from_records(root: str, root_stat: BareStat, top_paths: List[str], records: Dict[str, DirRecord]) -> 'CompactTree':
+        tree = CompactTree()
+        tree._add(root, -1, root_stat.file_count, root_stat.size, root_stat.max_size, root_stat.has_errors)
+        tree._add_children(0, [p for p in top_paths if p in records], records)
+        tree._roll_up(1)
+
+        return tree
+
+    def children(self, i: int) -> range:
+        return range(self.child_start[i], self.child_start[i] + self.child_count[i])
+
+    def path(self, i: int) -> str:
+        parts: List[str] = []
+
+        while i > 0:
+            parts.append(self.names[i])
+            i = self.parent[i]
+
+        return '/'.join([self.names[0]] + list(reversed(parts)))
+
+    def is_under(self, i: int, ancestor: int) -> bool:
+        while i > ancestor:
+            i = self.parent[i]
+
+        return i == ancestor
+
+    def stat(self, i: int, own: bool = False) -> 'NodeStat':
+        return NodeStat(self, i, own)
+
+    def replace_subtree(self, i: int, records: Dict[str, DirRecord]) -> None:
+        """Swaps in freshly scanned records for the subtree at i, the old descendants are left unreachable"""
+        path = self.path(i)
+        old_size = self.size[i]
+        old_count = self.count[i]
+        rec = records.get(path)
+
+        if rec is not None:
+            self.own_count[i] = rec.file_count
+            self.own_size[i] = rec.size
+            self.own_max[i] = rec.max_size
+            self.own_errors[i] = rec.has_errors
+        else:
+            # Gone or unreadable now
+            self.own_count[i] = self.own_size[i] = self.own_max[i] = 0
+
+        self.count[i] = self.own_count[i]
+        self.size[i] = self.own_size[i]
+        self.max[i] = self.own_max[i]
+        self.errors[i] = self.own_errors[i]
+        start = len(self)
+        self.child_count[i] = 0
+        self._add_children(i, [f'{path}/{s}' for s in rec.sub_dirs if f'{path}/{s}' in records] if rec else [], records)
+        self._roll_up(start)
+
+        size_delta = self.size[i] - old_size
+        count_delta = self.count[i] - old_count
+        p = self.parent[i]
+
+        while p >= 0:
+            self.size[p] += size_delta
+            self.count[p] += count_delta
+            self.max[p] = max([self.own_max[p]] + [self.max[c] for c in self.children(p)])
+            self.errors[p] = self.own_errors[p] or any(self.errors[c] for c in self.children(p))
+            p = self.parent[p]
+
+    def _add(self, name: str, parent: int, count: int, size: int, max_size: int, has_errors: bool) -> int:
+        self.names.append(name)
+        self.parent.append(parent)
+        self.child_start.append(0)
+        self.child_count.append(0)
+
+        for (own, total, v) in ((self.own_count, self.count, count), (self.own_size, self.size, size), (self.own_max, self.max, max_size),
+                                (self.own_errors, self.errors, has_errors)):
+            own.append(v)
+            total.append(v)
+
+        return len(self.names) - 1
+
+    def _add_children(self, i: int, child_paths: List[str], records: Dict[str, DirRecord]) -> None:
+        queue: Deque[Tuple[int, List[str]]] = deque([(i, child_paths)])
+
+        while queue:
+            (ni, paths) = queue.popleft()
+            self.child_start[ni] = len(self)
+            self.child_count[ni] = len(paths)
+
+            for p in paths:
+                rec = records[p]
+                ci = self._add(p[p.rindex('/') + 1:], ni, rec.file_count, rec.size, rec.max_size, rec.has_errors)
+                # Excluded dirs and mounts were never walked so they have no record
+                queue.append((ci, [f'{p}/{s}' for s in rec.sub_dirs if f'{p}/{s}' in records]))
+
+    def _roll_up(self, start: int) -> None:
+        # Children always come after their parent so a reverse sweep sees every subtree complete before its parent
+        for j in range(len(self) - 1, start - 1, -1):
+            p = self.parent[j]
+            self.size[p] += self.size[j]
+            self.count[p] += self.count[j]
+
+            if self.max[j] > self.max[p]:
+                self.max[p] = self.max[j]
+
+            if self.errors[j]:
+                self.errors[p] = True
+
+
+class NodeStat(Stat):
+    """Read only Stat view of one CompactTree node so the _fields sorters work on it"""
+    _tree: CompactTree
+    _i: int
+    _own: bool
+
+    def __init__(self, tree: CompactTree, i: int, own: bool = False):
+        super().__init__('./' if own else tree.names[i])
+        self._tree = tree
+        self._i = i
+        self._own = own
+
+    @property
+    def index(self) -> int:
+        return self._i
+
+    @property
+    def is_own_files(self) -> bool:
+        return self._own
+
+    @property
+    def has_errors(self) -> bool:
+        return bool((self._tree.own_errors if self._own else self._tree.errors)[self._i])
+
+    @property
+    def size(self) -> int:
+        return (self._tree.own_size if self._own else self._tree.size)[self._i]
+
+    @property
+    def file_count(self) -> int:
+        return (self._tree.own_count if self._own else self._tree.count)[self._i]
+
+    @property
+    def max_size(self) -> int:
+        return (self._tree.own_max if self._own else self._tree.max)[self._i]
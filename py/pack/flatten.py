@@ -11,7 +11,7 @@ if os.environ.get('ZSHCOM__feat_rclone') != 'true':
     exit(1)
 
 import rclone
-from typing import List, Callable, Tuple, TypeVar, Union
+from typing import List, Callable, Tuple, TypeVar, Union, Iterator
 
 from cli_args import BaseTap, RegExArg
 from utils import Ask
@@ -74,7 +74,7 @@ class RenameParts:
 
 
 class PathPartsRename:
-    _cb_replace: Callable[[Path, Path], RenameParts]
+    _cb_replace: Callable[[Path, Path, List[str]], RenameParts]
     _search_pattern: re.Pattern
     _replace_string: str
     _delimiter: str
@@ -108,17 +108,15 @@ class PathPartsRename:
                     elif option[i] == '/':
                         break
 
-    def replace(self, file: Path, root: Path) -> RenameParts:
-        return self._cb_replace(file, root)
-
-    def _default_replace(self, file: Path, root: Path) -> RenameParts:
-        parents = [prt.name for prt in file.relative_to(root).parents if prt.name]
-        parents.reverse()
+    def replace(self, file: Path, root: Path, parents: List[str]) -> RenameParts:
+        """parents are the folder names from root down to the file, as the walk collected them"""
+        return self._cb_replace(file, root, parents)
 
+    def _default_replace(self, file: Path, root: Path, parents: List[str]) -> RenameParts:
         return RenameParts(file, root, parents + [file.stem], file.suffix, self._delimiter)
 
-    def _re_replace(self, file: Path, root: Path) -> RenameParts:
-        pos_path = re.sub(_rx_leading_posix_path, '', file.relative_to(root).as_posix())
+    def _re_replace(self, file: Path, root: Path, parents: List[str]) -> RenameParts:
+        pos_path = re.sub(_rx_leading_posix_path, '', '/'.join(parents + [file.name]))
 
         res = Path(re.sub(self._search_pattern, self._replace_string, pos_path))
         return RenameParts(file, root, [res.stem], res.suffix, '')
@@ -178,13 +176,13 @@ _max_length = 254
 
 def flatten_path():
     root = _args.root.expanduser().resolve()
-    files = _flatten_path(root, root, 0)
 
     parents: List[str]
     f: Path
 
-    for (parents, f) in files:
-        nfn = _args.file_rename.replace(f, root)
+    # Files are moved as the walk finds them, the walk never holds more than the listings on its current path
+    for (parents, f) in _flatten_path(root):
+        nfn = _args.file_rename.replace(f, root, parents)
         skip_file = False
 
         def replace_dbyte(keep_emoji: bool):
@@ -289,10 +287,10 @@ def flatten_path():
         # exit()
 
         nfp = root / nfn.get_path_str()
-        rel = f.relative_to(root)
+        rel = '/'.join(parents + [f.name])
         n_rel = nfp.relative_to(root)
 
-        print(f'{rel.as_posix()}\n{n_rel.as_posix()}\n')
+        print(f'{rel}\n{n_rel.as_posix()}\n')
         if os.path.exists(nfp.as_posix()):
             print(f'Target file already exists: {n_rel}')
         else:
@@ -318,27 +316,37 @@ def _sort(collection: List[T], key: Callable[[T], R] = None, reverse: bool = Fal
         return sorted(collection, reverse=reverse)
 
 
-def _flatten_path(root: Path, target: Path, depth: int) -> List[Tuple[List[str], Path]]:
-    files: List[Tuple[List[str], Path]] = []
-    coll: List[Path] = _sort([pp for pp in target.iterdir()], lambda x: x.name, True)
+def _listing(path: Union[Path, str]) -> List[os.DirEntry]:
+    # Read in full before anything is moved, renames into root can't show up in a listing still being read
+    with os.scandir(path) as it:
+        return _sort(list(it), lambda x: x.name, True)
+
+
+def _flatten_path(root: Path) -> Iterator[Tuple[List[str], Path]]:
+    """Depth first over the sorted listings, yields each file to move with the folder names from root down to it"""
+    stack: List[Tuple[List[str], Iterator[os.DirEntry]]] = [([], iter(_listing(root)))]
 
-    for p in coll:
-        if p.is_file():
-            if depth == 0:
+    while stack:
+        (parents, entries) = stack[-1]
+        entry = next(entries, None)
+
+        if entry is None:
+            stack.pop()
+        elif entry.is_file():
+            # Files directly in root are already flat
+            if not parents:
                 continue
 
-            if _flatten_file(p, root):
-                rel = p.relative_to(root)
-                parents = [prt.name for prt in rel.parents if prt.name]
-                parents.reverse()
-                files.append((parents, p))
-        else:
-            files = files + _flatten_path(root, p, depth + 1)
+            f = Path(entry.path)
 
-    return files
+            if _flatten_file(f, parents):
+                yield parents, f
+        elif entry.is_dir():
+            # Shared by every file in the folder, never modified
+            stack.append((parents + [entry.name], iter(_listing(entry.path))))
 
 
-def _flatten_file(f: Path, root: Path) -> bool:
+def _flatten_file(f: Path, parents: List[str]) -> bool:
     global _skipped_re_filter
     suffix = f.suffix.strip('.').lower()
 
@@ -351,7 +359,7 @@ def _flatten_file(f: Path, root: Path) -> bool:
         _skipped_re_filter += 1
         return False
 
-    if _args.path_filter and not _args.path_filter.match(re.sub(_rx_leading_posix_path, '', f.relative_to(root).as_posix())):
+    if _args.path_filter and not _args.path_filter.match(re.sub(_rx_leading_posix_path, '', '/'.join(parents + [f.name]))):
         _skipped_re_filter += 1
         return False
 
@@ -7,7 +7,7 @@ setup(
     description='ZSH utils I find useful',
     author='c0d3m0nky',
     py_modules=[
-        'file_utils', 'utils', 'magic_files', 'logger', 'string_dbyte_utils', 'cli_args', 'disk_usage_models',
+        'file_utils', 'utils', 'magic_files', 'logger', 'string_dbyte_utils', 'cli_args', 'disk_usage_models', 'disk_usage_cache', 'disk_usage_tree', 'disk_usage_browser', 'disk_usage_formats', 'disk_usage_bench', 'disk_usage_exclude', 'disk_usage_throttle', 'disk_usage_snapshot', 'disk_usage_remote', 'disk_usage_filters',
         'update', 'flatten', 'rxmv', 'decomp', 'disk_usage', 'little_guys', 'dockur', 'replace_double_byte_chars',
         'git_auto_commit', 'disorder'
     ],
@@ -19,6 +19,7 @@ setup(
             'folderDensity=folder_density:main',
             'decomp=decomp:main',
             'duh=disk_usage:main',
+            'duh-bench=disk_usage_bench:main',
             'fack=little_guys:fack',
             'repdb=replace_double_byte_chars:main',
             'git_auto_commit=git_auto_commit:main',
@@ -31,7 +32,6 @@ setup(
         'numpy',
         'emoji',
         'GitPython',
-        'tqdm',
         'py7zr',
         'unrar2-cffi',
         'docker',